@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+APP_ADMISSION_PATHS = tuple(
+    x for x in os.getenv("APP_ADMISSION_PATHS", "/c,/i").split(",") if x
+)
+# Tokens per second and bucket size, per `j` username and per client IP.
+APP_USER_RATE = float(os.getenv("APP_USER_RATE", "0.2"))
+APP_USER_BURST = float(os.getenv("APP_USER_BURST", "10"))
+APP_IP_RATE = float(os.getenv("APP_IP_RATE", "0.5"))
+APP_IP_BURST = float(os.getenv("APP_IP_BURST", "20"))
+# Requests in flight on the admission paths before we start shedding.
+APP_MAX_INFLIGHT = int(os.getenv("APP_MAX_INFLIGHT", "32"))
+# Upper bound on tracked buckets, per key kind.
+APP_MAX_BUCKETS = int(os.getenv("APP_MAX_BUCKETS", "10000"))
+# Longest Retry-After we send, also used when a rate is 0.
+MAX_WAIT = 3600  # seconds
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Helpers
+# -------------------------------------------------------------------
+
+
+def client_ip(request: Request) -> Optional[str]:
+    """
+    Real client IP behind Caddy.
+    """
+    return (
+        request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+        or request.headers.get("x-real-ip")
+        or (request.client.host if request.client else None)
+    )
+
+
+# -------------------------------------------------------------------
+# Token buckets
+# -------------------------------------------------------------------
+
+
+class TokenBuckets:
+    """
+    Token buckets keyed by string, in one insertion ordered dict.
+
+    Each bucket is a `(tokens, last_seen)` tuple and is moved to the end
+    on every use, so the front of the dict always holds the idlest keys.
+    A bucket idle long enough to refill completely is the same as no
+    bucket, so those are dropped, and the dict never exceeds `max_keys`.
+    """
+
+    __slots__ = ("rate", "burst", "max_keys", "idle", "_buckets")
+
+    def __init__(self, rate: float, burst: float, max_keys: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle = burst / rate if rate > 0 else math.inf
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Take one token. Returns 0 when allowed, otherwise seconds to wait.
+        """
+        now = time.monotonic() if now is None else now
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate if self.rate > 0 else MAX_WAIT
+            wait = min(wait, MAX_WAIT)
+
+        self._buckets[key] = (tokens, now)
+        self._expire(now)
+        return wait
+
+    def refund(self, key: str) -> None:
+        """
+        Give back a token taken for a request that was rejected elsewhere.
+        """
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (min(self.burst, bucket[0] + 1), bucket[1])
+
+    def _expire(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets:
+            key, (_, last) = next(iter(buckets.items()))
+            if len(buckets) > self.max_keys or now - last >= self.idle:
+                del buckets[key]
+            else:
+                break
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# -------------------------------------------------------------------
+# Admission
+# -------------------------------------------------------------------
+
+
+class Admission:
+    """
+    Per username and per IP token buckets, plus a cap on requests in flight.
+    """
+
+    def __init__(self) -> None:
+        self.users = TokenBuckets(APP_USER_RATE, APP_USER_BURST, APP_MAX_BUCKETS)
+        self.ips = TokenBuckets(APP_IP_RATE, APP_IP_BURST, APP_MAX_BUCKETS)
+        self.inflight = 0
+        self.rejected: Dict[str, int] = {"user": 0, "ip": 0, "busy": 0}
+
+    def admit(self, request: Request) -> Tuple[str, float]:
+        """
+        Returns an empty reason when admitted, otherwise the reason and
+        how many seconds the client should wait.
+        """
+        if self.inflight >= APP_MAX_INFLIGHT:
+            return "busy", 1
+
+        now = time.monotonic()
+        ip = client_ip(request)
+        if ip:
+            wait = self.ips.take(ip, now)
+            if wait:
+                return "ip", wait
+
+        username = request.query_params.get("j")
+        if username:
+            wait = self.users.take(username, now)
+            if wait:
+                # One throttled account must not drain its IP for the others.
+                if ip:
+                    self.ips.refund(ip)
+                return "user", wait
+
+        return "", 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inflight": self.inflight,
+            "user_buckets": len(self.users),
+            "ip_buckets": len(self.ips),
+            "rejected": dict(self.rejected),
+        }
+
+
+admission = Admission()
+
+
+class AdmissionMiddleware:
+    """
+    Applies `admission` to `/c` and `/i` before they reach the threadpool.
+    Rejected requests get `429` with `Retry-After`.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in APP_ADMISSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        reason, wait = admission.admit(request)
+        if reason:
+            admission.rejected[reason] += 1
+            logger.warning(
+                "Rejected %s for %s (%s)",
+                scope["path"],
+                request.query_params.get("j") or client_ip(request),
+                reason,
+            )
+            response = JSONResponse(
+                status_code=429,
+                content={"message": "Too many requests, slow down."},
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+            await response(scope, receive, send)
+            return
+
+        admission.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.inflight -= 1
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import httpx
+
+from .deadline import DeadlineExceeded
+
+T = TypeVar("T")
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# Consecutive failures that open a circuit.
+APP_BREAKER_FAILURES = int(os.getenv("APP_BREAKER_FAILURES", "5"))
+# Seconds an open circuit fails fast before letting a probe through.
+APP_BREAKER_RESET = float(os.getenv("APP_BREAKER_RESET", "30"))
+# Probes allowed at once while half-open.
+APP_BREAKER_HALF_OPEN = int(os.getenv("APP_BREAKER_HALF_OPEN", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Breaker
+# -------------------------------------------------------------------
+
+
+class CircuitOpenError(httpx.TransportError):
+    """
+    Raised instead of calling an upstream that is known to be down.
+
+    It is a transport error, so callers already handling an unreachable
+    upstream handle this too.
+    """
+
+
+def upstream_failure(exc: BaseException) -> bool:
+    """
+    Whether `exc` means the upstream is unwell, as opposed to saying no.
+    """
+    if isinstance(exc, (CircuitOpenError, DeadlineExceeded)):
+        return False
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def unavailable(exc: BaseException) -> bool:
+    """
+    Whether the upstream is down, restarting, behind an open circuit or
+    could not answer within the request budget.
+    """
+    if isinstance(exc, (CircuitOpenError, DeadlineExceeded)):
+        return True
+    return upstream_failure(exc)
+
+
+breakers: List["CircuitBreaker"] = []
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through and consecutive failures are counted.
+    Open: calls fail at once with `CircuitOpenError` for `reset_timeout`.
+    Half-open: a few probe calls go through, a success closes the circuit
+    and a failure opens it again.
+
+    Wrap the call inside the single-flight leader, so a coalesced burst
+    counts as one call.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failures: int = APP_BREAKER_FAILURES,
+        reset_timeout: float = APP_BREAKER_RESET,
+        half_open_calls: int = APP_BREAKER_HALF_OPEN,
+    ) -> None:
+        self.name = name
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        breakers.append(self)
+
+    def _before(self) -> None:
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"{self.name} circuit is open")
+                self.state = HALF_OPEN
+                self.probes = 0
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"{self.name} circuit is half-open")
+                self.probes += 1
+
+    def _after(self, exc: Optional[BaseException]) -> None:
+        with self._lock:
+            if exc is not None and (
+                not isinstance(exc, Exception) or isinstance(exc, DeadlineExceeded)
+            ):
+                # Cancelled or cut short, we learned nothing. Give the probe back.
+                if self.state == HALF_OPEN:
+                    self.probes -= 1
+                return
+
+            if exc is not None and upstream_failure(exc):
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= self.threshold:
+                    if self.state != OPEN:
+                        logger.warning(
+                            "%s circuit opened after %d failures: %s",
+                            self.name,
+                            self.failures,
+                            exc,
+                        )
+                        self.opened += 1
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+                return
+
+            if self.state == HALF_OPEN:
+                logger.info("%s circuit closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+
+    def call(self, fn: Callable[[], T]) -> T:
+        self._before()
+        try:
+            result = fn()
+        except BaseException as exc:
+            self._after(exc)
+            raise
+        self._after(None)
+        return result
+
+    async def call_async(self, fn: Callable[[], Awaitable[T]]) -> T:
+        self._before()
+        try:
+            result = await fn()
+        except BaseException as exc:
+            self._after(exc)
+            raise
+        self._after(None)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+def stats() -> List[Dict[str, Any]]:
+    return [b.stats() for b in breakers]
+
+
+ssm_breaker = CircuitBreaker("ssm")
+github_breaker = CircuitBreaker("github")
+jsdelivr_breaker = CircuitBreaker("jsdelivr")
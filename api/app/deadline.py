@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import math
+import os
+import time
+from typing import Callable, List, TypeVar
+
+import httpx
+
+from .singleflight import SingleFlight, WaitTimeout
+
+T = TypeVar("T")
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# Time budget of one `/c` request, 0 disables it.
+APP_REQUEST_BUDGET_MS = float(os.getenv("APP_REQUEST_BUDGET_MS", "1500"))
+# Below this, an optional upstream call is not worth starting.
+MIN_CALL = 0.05  # seconds
+
+# Lists the degraded parts of a `/c` response.
+DEGRADED_HEADER = "X-Degraded"
+
+# -------------------------------------------------------------------
+# Deadline
+# -------------------------------------------------------------------
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """
+    An upstream call timed out only because the request budget cut its
+    timeout short. Says nothing about the upstream's health.
+    """
+
+
+class Deadline:
+    """
+    What is left of a request's time budget, passed down to every step.
+
+    Required steps, verifying the user and loading the templates, run
+    regardless with their full upstream timeouts, there is no config without
+    them. Optional enrichments check `exhausted()` first, shrink their
+    upstream timeouts to `timeout()`, wait on shared calls through `join()`
+    and call `degrade()` when they fall back to a cached answer or are left
+    out.
+    """
+
+    __slots__ = ("expires", "degraded")
+
+    def __init__(self, budget: float) -> None:
+        self.expires = time.monotonic() + budget if budget > 0 else float("inf")
+        self.degraded: List[str] = []
+
+    @classmethod
+    def for_request(cls) -> "Deadline":
+        return cls(APP_REQUEST_BUDGET_MS / 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def exhausted(self) -> bool:
+        return self.remaining() < MIN_CALL
+
+    def timeout(self, cap: float) -> float:
+        return min(cap, self.remaining())
+
+    def call(self, fn: Callable[[float], T], cap: float) -> T:
+        """
+        Run `fn(timeout)` with the upstream timeout capped by what is left.
+        """
+        timeout = self.timeout(cap)
+        try:
+            return fn(timeout)
+        except httpx.TimeoutException as exc:
+            if timeout >= cap:
+                raise
+            raise DeadlineExceeded(str(exc) or "request budget exhausted") from exc
+
+    def join(self, flight: SingleFlight, key: str, fn: Callable[[], T]) -> T:
+        """
+        `flight.do(key, fn)`, waiting on a call started by someone without
+        this budget, e.g. the materializer, only for what is left of it.
+        """
+        remaining = self.remaining()
+        try:
+            return flight.do(key, fn, None if math.isinf(remaining) else remaining)
+        except WaitTimeout as exc:
+            raise DeadlineExceeded(str(exc)) from exc
+
+    def degrade(self, part: str) -> None:
+        if part not in self.degraded:
+            self.degraded.append(part)
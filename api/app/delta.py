@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi.responses import Response
+
+from .deadline import DEGRADED_HEADER
+from .memory import APP_LOW_MEMORY, ByteLRU
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# Rendered versions kept per user, and the byte budget for all of them.
+APP_DELTA_HISTORY = int(os.getenv("APP_DELTA_HISTORY", "4"))
+APP_DELTA_BUDGET_BYTES = int(
+    os.getenv(
+        "APP_DELTA_BUDGET_BYTES",
+        str(2 << 20) if APP_LOW_MEMORY else str(8 << 20),
+    )
+)
+
+PATCH_MEDIA_TYPE = "application/json-patch+json"
+STALE_WARNING = '110 - "Response is Stale"'
+
+# -------------------------------------------------------------------
+# JSON Patch (RFC 6902)
+# -------------------------------------------------------------------
+
+
+def _pointer(path: str, token: Any) -> str:
+    return f"{path}/{str(token).replace('~', '~0').replace('/', '~1')}"
+
+
+def diff(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+    """
+    JSON Patch turning `old` into `new`.
+
+    Lists are compared index by index, with the tail added or removed, which
+    is good enough for configs where entries are edited in place.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: List[Dict[str, Any]] = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in new.items():
+            if key in old:
+                ops.extend(diff(old[key], value, _pointer(path, key)))
+            else:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(diff(old[i], new[i], _pointer(path, i)))
+        for value in new[common:]:
+            ops.append({"op": "add", "path": f"{path}/-", "value": value})
+        for i in range(len(old) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": _pointer(path, i)})
+        return ops
+
+    if old == new and type(old) is type(new):
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def dumps(document: Any) -> bytes:
+    """
+    Same bytes as `JSONResponse` renders.
+    """
+    return json.dumps(
+        document,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def version_of(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()[:16]
+
+
+# -------------------------------------------------------------------
+# History
+# -------------------------------------------------------------------
+
+
+class ConfigHistory:
+    """
+    The last few rendered configs of every user, gzip compressed.
+
+    Entries live in one byte budgeted LRU, so a version may be gone before
+    it falls out of its user's window. Callers then send the full config.
+    """
+
+    def __init__(self, per_user: int, budget: int) -> None:
+        self.per_user = per_user
+        self.documents = ByteLRU("delta", budget)
+        self.versions: Dict[str, Deque[str]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, username: str, body: bytes) -> str:
+        """
+        Remember `body` as a version of `username`'s config, returns its hash.
+        """
+        version = version_of(body)
+        if not self.has(username, version):
+            self.record_compressed(username, version, gzip.compress(body, mtime=0))
+        return version
+
+    def record_compressed(self, username: str, version: str, compressed: bytes) -> None:
+        with self._lock:
+            window = self.versions.setdefault(username, deque())
+            if version in window:
+                window.remove(version)
+            window.append(version)
+            while len(window) > self.per_user:
+                self.documents.discard(f"{username}:{window.popleft()}")
+        self.documents.put(f"{username}:{version}", compressed)
+
+    def has(self, username: str, version: str) -> bool:
+        with self._lock:
+            return version in self.versions.get(username, ())
+
+    def get(self, username: str, version: str) -> Optional[Any]:
+        raw = self.documents.get(f"{username}:{version}")
+        if raw is None:
+            return None
+        return json.loads(gzip.decompress(raw))
+
+    def forget(self, username: str) -> None:
+        with self._lock:
+            for version in self.versions.pop(username, ()):
+                self.documents.discard(f"{username}:{version}")
+
+
+history = ConfigHistory(APP_DELTA_HISTORY, APP_DELTA_BUDGET_BYTES)
+
+
+# -------------------------------------------------------------------
+# Responses
+# -------------------------------------------------------------------
+
+
+def config_response(
+    username: str,
+    config: Dict[str, Any],
+    base_version: str = "",
+    stale: bool = False,
+    degraded: Optional[List[str]] = None,
+    verified: bool = True,
+) -> Response:
+    """
+    The full config, or a JSON Patch when the client sent a version we still
+    remember and the patch is smaller than the config itself.
+
+    `degraded` names the optional parts left out or served from cache.
+    Configs rendered for a wrong PSK never touch the history, so they cannot
+    evict the versions the user's clients hold.
+    """
+    body = dumps(config)
+    version = history.record(username, body) if verified else version_of(body)
+    headers = {"X-Config-Version": version, "ETag": f'"{version}"'}
+    if stale:
+        headers["Warning"] = STALE_WARNING
+    if degraded:
+        headers[DEGRADED_HEADER] = ", ".join(degraded)
+
+    if base_version and verified:
+        base = history.get(username, base_version)
+        if base is not None:
+            patch = dumps(diff(base, config))
+            if len(patch) < len(body):
+                headers["X-Config-Base"] = base_version
+                return Response(patch, media_type=PATCH_MEDIA_TYPE, headers=headers)
+
+    return Response(body, media_type="application/json", headers=headers)
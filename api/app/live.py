@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from .utils import Stats, get_stats
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# Seconds between stats polls while at least one dashboard is open.
+APP_LIVE_INTERVAL = float(os.getenv("APP_LIVE_INTERVAL", "5"))
+# Events buffered per dashboard before it is resynced with a snapshot.
+APP_LIVE_QUEUE = int(os.getenv("APP_LIVE_QUEUE", "16"))
+KEEPALIVE = 15  # seconds
+
+# Counters pushed to the dashboard, all of them are StatsRow slots.
+FIELDS = (
+    "downlinkBytes",
+    "uplinkBytes",
+    "tcpSessions",
+    "udpSessions",
+)
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Helpers
+# -------------------------------------------------------------------
+
+
+def sse(event: str, data: Any) -> bytes:
+    payload = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+
+# -------------------------------------------------------------------
+# Broadcaster
+# -------------------------------------------------------------------
+
+
+class StatsBroadcaster:
+    """
+    One stats poll shared by every open dashboard.
+
+    The poll only runs while somebody is subscribed. Each round is diffed
+    against the previous one and only the counters that moved are sent.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.rows: Dict[str, Dict[str, int]] = {}
+        self.stale = False
+        self.subscribers: Set["asyncio.Queue[bytes]"] = set()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def snapshot(self) -> bytes:
+        return sse("snapshot", {"stale": self.stale, "users": self.rows})
+
+    def subscribe(self) -> "asyncio.Queue[bytes]":
+        queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=APP_LIVE_QUEUE)
+        self.subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: "asyncio.Queue[bytes]") -> None:
+        self.subscribers.discard(queue)
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self.rows = {}
+
+    def _publish(self, message: bytes) -> None:
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow to keep up with deltas, start it over.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot())
+
+    def _diff(self, stats: Stats) -> Optional[Dict[str, Any]]:
+        rows = {
+            row.username: {f: getattr(row, f) for f in FIELDS} for row in stats
+        }
+        changed: Dict[str, Dict[str, int]] = {}
+        for username, row in rows.items():
+            old = self.rows.get(username, {})
+            fields = {f: v for f, v in row.items() if old.get(f) != v}
+            if fields:
+                changed[username] = fields
+        removed: List[str] = [u for u in self.rows if u not in rows]
+        stale_changed = stats.stale != self.stale
+
+        self.rows = rows
+        self.stale = stats.stale
+        if not (changed or removed or stale_changed):
+            return None
+        return {"stale": stats.stale, "users": changed, "removed": removed}
+
+    async def _run(self) -> None:
+        first = True
+        while True:
+            try:
+                stats = await get_stats()
+            except HTTPException as exc:
+                logger.warning("Live stats poll failed: %s", exc.detail)
+            except Exception:
+                # A malformed answer must not end the poll for every dashboard.
+                logger.exception("Live stats poll failed")
+            else:
+                delta = self._diff(stats)
+                if first:
+                    self._publish(self.snapshot())
+                    first = False
+                elif delta:
+                    self._publish(sse("delta", delta))
+            await asyncio.sleep(self.interval)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        Server-Sent Events for one dashboard.
+        """
+        queue = self.subscribe()
+        try:
+            if self.rows:
+                yield self.snapshot()
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+        finally:
+            self.unsubscribe(queue)
+
+
+broadcaster = StatsBroadcaster(APP_LIVE_INTERVAL)
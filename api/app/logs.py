@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, TextIO
+
+from fastapi.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .admission import client_ip
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# JSON lines for everything, otherwise the old text format.
+APP_LOG_JSON: bool = os.getenv("APP_LOG_JSON", "false") == "true"
+APP_ACCESS_LOG: bool = os.getenv("APP_ACCESS_LOG", "true") == "true"
+# Empty writes to stdout, where docker picks it up.
+APP_LOG_PATH = os.getenv("APP_LOG_PATH", "")
+# Records waiting for the writer, more than this are dropped and counted.
+APP_LOG_QUEUE = int(os.getenv("APP_LOG_QUEUE", "10000"))
+APP_LOG_BATCH = int(os.getenv("APP_LOG_BATCH", "256"))
+# Fraction of requests whose debug logs are kept, 0 keeps none.
+APP_LOG_DEBUG_SAMPLE = float(os.getenv("APP_LOG_DEBUG_SAMPLE", "0"))
+
+IDLE_POLL = 0.5  # seconds
+REQUEST_ID_HEADER = "x-request-id"
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# Attributes every LogRecord has, anything else was passed as `extra`.
+RESERVED = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "request_id", default=""
+)
+_debug_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "debug_sampled", default=False
+)
+
+access_logger = logging.getLogger("access")
+
+# -------------------------------------------------------------------
+# Formatting
+# -------------------------------------------------------------------
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the request id and any `extra` fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        rid = getattr(record, "request_id", "")
+        if rid:
+            entry["request_id"] = rid
+        for key, value in vars(record).items():
+            if key not in RESERVED and key != "request_id":
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Stamps records with the current request id, and keeps DEBUG records
+    only for requests picked by `APP_LOG_DEBUG_SAMPLE`.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        if record.levelno <= logging.DEBUG:
+            return _debug_sampled.get()
+        return True
+
+
+# -------------------------------------------------------------------
+# Queue and writer
+# -------------------------------------------------------------------
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks the caller: records are rendered to plain data here and
+    dropped, and counted, when the writer can not keep up.
+    """
+
+    def __init__(self, q: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments may be mutated once we return, so render them now.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchWriter:
+    """
+    Background thread draining the log queue.
+
+    Formatting happens here, off the request path. Records that piled up
+    are written together, up to `batch` lines with one write and one flush.
+    """
+
+    def __init__(
+        self,
+        q: "queue.Queue[logging.LogRecord]",
+        formatter: logging.Formatter,
+        stream: TextIO,
+        batch: int,
+    ) -> None:
+        self.queue = q
+        self.formatter = formatter
+        self.stream = stream
+        self.batch = batch
+        self.written = 0
+        self.batches = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="log-writer", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Write what is queued and stop the thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._drain()
+
+    def _take(self) -> List[logging.LogRecord]:
+        records: List[logging.LogRecord] = []
+        try:
+            records.append(self.queue.get(timeout=IDLE_POLL))
+        except queue.Empty:
+            return records
+        # Whatever piled up while the last batch was written goes out together.
+        while len(records) < self.batch:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _write(self, records: List[logging.LogRecord]) -> None:
+        lines: List[str] = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                lines.append(f"unformattable log record from {record.name}")
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (OSError, ValueError):
+            return
+        self.written += len(lines)
+        self.batches += 1
+
+    def _drain(self) -> None:
+        records: List[logging.LogRecord] = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self._write(records)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            records = self._take()
+            if records:
+                self._write(records)
+
+
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=APP_LOG_QUEUE)
+queue_handler = DroppingQueueHandler(_log_queue)
+writer = BatchWriter(
+    _log_queue,
+    JsonFormatter() if APP_LOG_JSON else logging.Formatter(TEXT_FORMAT),
+    open(APP_LOG_PATH, "a", buffering=1 << 16) if APP_LOG_PATH else sys.stdout,
+    APP_LOG_BATCH,
+)
+
+
+def setup_logging() -> None:
+    """
+    Route the root logger through the queue, at INFO unless debug records
+    are sampled. The only place handlers are set up. Idempotent.
+    """
+    root = logging.getLogger()
+    if queue_handler in root.handlers:
+        return
+    queue_handler.addFilter(RequestContextFilter())
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    if APP_ACCESS_LOG:
+        # Ours has the request id and the user, uvicorn's would be a duplicate.
+        logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
+    if APP_LOG_DEBUG_SAMPLE > 0:
+        root.setLevel(logging.DEBUG)
+        # Libraries would flood the sampled requests.
+        for name in ("httpx", "httpcore", "apscheduler", "asyncio"):
+            logging.getLogger(name).setLevel(logging.INFO)
+    writer.start()
+
+
+def stats() -> Dict[str, int]:
+    return {
+        "queued": _log_queue.qsize(),
+        "dropped": queue_handler.dropped,
+        "written": writer.written,
+        "batches": writer.batches,
+    }
+
+
+# -------------------------------------------------------------------
+# Middleware
+# -------------------------------------------------------------------
+
+
+class AccessLogMiddleware:
+    """
+    Gives every request a correlation id, taken from `X-Request-Id` or made
+    up, returns it in the response and writes one access log record.
+
+    Query strings are never logged, `k` is a password.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        rid = request.headers.get(REQUEST_ID_HEADER, "")[:64] or uuid.uuid4().hex
+        rid_token = request_id.set(rid)
+        sampled_token = _debug_sampled.set(
+            APP_LOG_DEBUG_SAMPLE > 0 and random.random() < APP_LOG_DEBUG_SAMPLE
+        )
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_id(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", []).append(
+                    (REQUEST_ID_HEADER.encode(), rid.encode("latin-1"))
+                )
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if APP_ACCESS_LOG:
+                access_logger.info(
+                    "%s %s %d",
+                    scope["method"],
+                    scope["path"],
+                    status,
+                    extra={
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": status,
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                        "bytes": size,
+                        "ip": client_ip(request),
+                        "user": request.query_params.get("j", ""),
+                        "ua": request.headers.get("user-agent", ""),
+                    },
+                )
+            request_id.reset(rid_token)
+            _debug_sampled.reset(sampled_token)
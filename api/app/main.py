@@ -2,6 +2,7 @@ import logging
 import os
 import urllib.parse
 from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import Any, Callable, Dict, Type, Union
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -9,26 +10,54 @@ from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.requests import Request
-from fastapi.responses import JSONResponse, Response, HTMLResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, HTMLResponse
 
 # from pydantic import BaseModel
-from fastapi.templating import Jinja2Templates
 
+from .admission import AdmissionMiddleware, client_ip
+from .deadline import Deadline
+from .delta import STALE_WARNING, config_response, history
+from .logs import AccessLogMiddleware, setup_logging, writer
+from .materializer import (
+    APP_MATERIALIZE,
+    APP_MATERIALIZE_INTERVAL,
+    is_default_request,
+    materializer,
+)
+from .memory import APP_LOW_MEMORY, get_templates, log_rss
+from .profiler import APP_PROFILE, ProfilerMiddleware, attach
+from .prober import APP_PROBE, APP_PROBE_INTERVAL, probe_outbounds
+from .provisioning import APP_RECONCILE_INTERVAL, reconciler
+from .store import APP_USERS_EXPORT_INTERVAL, store
 from .routes.ssm import router as ssm_router
 from .routes.ssm_transparent import router as ssm_transparent_router
-from .utils import Reader, get_stats
+from .utils import (
+    APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER,
+    APP_DEFAULT_DNS_DETOUR,
+    APP_DEFAULT_DNS_FINAL,
+    APP_DEFAULT_DNS_HOST,
+    APP_DEFAULT_DNS_PATH,
+    APP_DEFAULT_DNS_RESOLVER,
+    APP_DEFAULT_DNS_VERSION,
+    APP_DEFAULT_LOG_LEVEL,
+    APP_DEFAULT_MULTIPLEX_ENABLED,
+    APP_DEFAULT_PLATFORM,
+    APP_DEFAULT_ROUTE_DETOUR,
+    APP_DEFAULT_VERSION,
+    APP_SSM_UPSTREAM,
+    Reader,
+    get_stats,
+    load_json,
+    verify_user,
+)
 
 scheduler: AsyncIOScheduler = AsyncIOScheduler()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()],
-)
+setup_logging()
 
 
 async def not_found(request: Request, exc: Any) -> Response:
-    logging.info(f"404 Error: {exc}")
+    logging.info("404 Error: %s", exc)
     return JSONResponse(
         status_code=404,
         content={"message": "The resource you are looking for is not found."},
@@ -36,7 +65,7 @@ async def not_found(request: Request, exc: Any) -> Response:
 
 
 async def internal_error(request: Request, exc: Exception) -> Response:
-    logging.exception(f"500 Error: {exc}")
+    logging.exception("500 Error: %s", exc)
     return JSONResponse(
         status_code=500,
         content={"message": "Nice! server error occurred."},
@@ -44,7 +73,7 @@ async def internal_error(request: Request, exc: Exception) -> Response:
 
 
 async def validation_error(request: Request, exc: RequestValidationError) -> Response:
-    logging.info(f"400 Error: {exc}")
+    logging.info("400 Error: %s", exc)
     return JSONResponse(
         status_code=400,
         content={"message": str(exc)},
@@ -62,11 +91,22 @@ async def check_quota_exceeded_task() -> None:
     """Pretend this function notify via Telegram when quota is exceeded"""
     stats = await get_stats()
     if len(stats) > 10:  # Arbitrary threshold for demonstration
-        logging.info(f"Top 5 users: {stats[:5]}")
+        logging.info("Top 5 users: %s", stats[:5])
     else:
         logging.info("Quota check omitted.")
 
 
+async def probe_outbounds_task() -> None:
+    """Measure the handshake latency of every outbound in outbounds.json"""
+    outbounds_path = os.getenv("APP_OUTBOUNDS_PATH", "test_data/outbounds.json")
+    try:
+        outbounds = load_json(outbounds_path).get("outbounds", [])
+    except Exception as exc:
+        logging.warning("Probe omitted: %s", exc)
+        return
+    await probe_outbounds(outbounds)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Run once at startup
@@ -75,12 +115,57 @@ async def lifespan(app: FastAPI):
         "interval",
         seconds=60,
     )
+    if APP_LOW_MEMORY:
+        scheduler.add_job(  # type: ignore
+            log_rss,
+            "interval",
+            args=["interval"],
+            seconds=300,
+        )
+    if store is not None:
+        store.import_json(os.getenv("APP_USERS_DATA_PATH", "test_data/users.jsonc"))
+        scheduler.add_job(  # type: ignore
+            store.export,
+            "interval",
+            seconds=APP_USERS_EXPORT_INTERVAL,
+            max_instances=1,
+        )
+    if APP_PROBE:
+        scheduler.add_job(  # type: ignore
+            probe_outbounds_task,
+            "interval",
+            seconds=APP_PROBE_INTERVAL,
+            next_run_time=datetime.now(),
+            max_instances=1,
+        )
+    if APP_RECONCILE_INTERVAL:
+        # sing-box forgets SSM users on restart, put them back.
+        scheduler.add_job(  # type: ignore
+            reconciler.run,
+            "interval",
+            seconds=APP_RECONCILE_INTERVAL,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True,
+        )
+    if APP_MATERIALIZE:
+        # Runs in the scheduler's thread pool, rendering is blocking work.
+        scheduler.add_job(  # type: ignore
+            materializer.run,
+            "interval",
+            seconds=APP_MATERIALIZE_INTERVAL,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True,
+        )
     scheduler.start()  # type: ignore
+    log_rss("startup")
 
     yield  # App runs here
 
     # App tearsdown: cleanup logic on shutdown and so on
     scheduler.shutdown()  # type: ignore
+    writer.stop()
 
 
 app = FastAPI(exception_handlers=exceptions, lifespan=lifespan)
@@ -108,14 +193,17 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if APP_PROFILE:
+    app.add_middleware(ProfilerMiddleware)
+app.add_middleware(AdmissionMiddleware)
+# Outermost, so rejected requests are logged and everything has a request id.
+app.add_middleware(AccessLogMiddleware)
 
 
 # class User(BaseModel):
 #     j: str
 #     k: str
 
-templates = Jinja2Templates(directory="templates")
-
 
 @app.get("/")
 def read_root(request: Request):
@@ -124,35 +212,39 @@ def read_root(request: Request):
     Returns:
         _TemplateResponse: _nginx default page_
     """
-    return templates.TemplateResponse("index.html", {"request": request})
+    return get_templates().TemplateResponse("index.html", {"request": request})
 
 
 @app.get("/c", response_class=JSONResponse)
 def read_config(
     request: Request,
     # Common options
-    p: str = os.getenv("APP_DEFAULT_PLATFORM", "a"),
-    v: int = int(os.getenv("APP_DEFAULT_VERSION", 12)),
-    ll: str = os.getenv("APP_DEFAULT_LOG_LEVEL", "warn"),
+    p: str = APP_DEFAULT_PLATFORM,
+    v: int = APP_DEFAULT_VERSION,
+    ll: str = APP_DEFAULT_LOG_LEVEL,
     # DNS options
-    dh: str = os.getenv("APP_DEFAULT_DNS_HOST", "dns.nextdns.io"),
-    dp: str = os.getenv("APP_DEFAULT_DNS_PATH", "/"),
-    dd: str = os.getenv("APP_DEFAULT_DNS_DETOUR", "Out"),
-    df: str = os.getenv("APP_DEFAULT_DNS_FINAL", "dns-remote"),
-    dr: str = os.getenv("APP_DEFAULT_DNS_RESOLVER", "1.1.1.1"),
-    dv: int = int(os.getenv("APP_DEFAULT_DNS_VERSION", 4)),
-    ddr: str = os.getenv("APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER", "dns-remote"),
+    dh: str = APP_DEFAULT_DNS_HOST,
+    dp: str = APP_DEFAULT_DNS_PATH,
+    dd: str = APP_DEFAULT_DNS_DETOUR,
+    df: str = APP_DEFAULT_DNS_FINAL,
+    dr: str = APP_DEFAULT_DNS_RESOLVER,
+    dv: int = APP_DEFAULT_DNS_VERSION,
+    ddr: str = APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER,
     # Route options
-    rd: str = os.getenv("APP_DEFAULT_ROUTE_DETOUR", "Out"),
+    rd: str = APP_DEFAULT_ROUTE_DETOUR,
     crs: str = "",  # Custom Route Rule Sets, APP_DEFAULT_OTHER_RULE_SETS has higher priority
     # User authentication
     j: str = "",  # Required
     k: str = "",  # Required
     # Experimental options
-    mx: bool = os.getenv("APP_DEFAULT_MULTIPLEX_ENABLED") == "true",
+    mx: bool = APP_DEFAULT_MULTIPLEX_ENABLED,
+    # Config version the client already has, answered with a JSON Patch
+    cv: str = "",
     please: bool = False,
     # Humorous parameter to appease the server
-) -> dict[str, Any]:
+) -> Response:
+    attach()  # No-op unless this request is being profiled
+    deadline = Deadline.for_request()
 
     # Nothing to check if `j` and `k` aren't provided.
     if not j or not k:
@@ -184,15 +276,39 @@ def read_config(
         p = p  # Use the provided platform
         v = v  # Use the provided version
 
-    real_ip = (
-        request.headers.get("x-forwarded-for", "").split(",")[0].strip()
-        or request.headers.get("x-real-ip")
-        or (request.client.host if request.client else None),
-    )
-    logging.info(f"Received request: {j}-{real_ip}")
+    real_ip = client_ip(request)
+    logging.info("Received request: %s-%s", j, real_ip)
+
+    # Default parameters are served straight from the materialized files.
+    if (
+        APP_MATERIALIZE
+        and (cv or "gzip" in request.headers.get("accept-encoding", ""))
+        and is_default_request(ll, dh, dp, dd, df, dr, dv, ddr, rd, crs)
+    ):
+        found = materializer.lookup(j, k, p, v, mx)
+        verified, stale = (
+            verify_user(APP_SSM_UPSTREAM, j, k) if found else (False, False)
+        )
+        if found and verified:
+            path, version = found
+            if not cv:
+                headers = {
+                    "Content-Encoding": "gzip",
+                    "Vary": "Accept-Encoding",
+                    "X-Config-Version": version,
+                    "ETag": f'"{version}"',
+                }
+                if stale:
+                    headers["Warning"] = STALE_WARNING
+                return FileResponse(
+                    path, media_type="application/json", headers=headers
+                )
+            config = history.get(j, version)
+            if config is not None:
+                return config_response(j, config, cv, stale)
 
     # Server will assume default value if any parameter is missing
-    return Reader(
+    reader = Reader(
         username=j,  # Required
         psk=k,  # Required
         platform=p,
@@ -208,13 +324,19 @@ def read_config(
         route_detour=rd,
         multiplex=mx,
         custom_rule_sets=crs,
-    ).unwarp()
+        deadline=deadline,
+    )
+    config = reader.unwarp()
+    # Returning a Response skips FastAPI's jsonable_encoder copy of the config.
+    return config_response(
+        j, config, cv, reader.stale, deadline.degraded, reader.verified
+    )
 
 
 @app.get("/i", response_class=HTMLResponse)
 def read_user(request: Request, p: str = "a", v: int = 12, j: str = "", k: str = ""):
     url = "https://" + APP_HOST + f"/c?p={p}&v={v}&j={j}&k={k}"
     encoded_url = f"sing-box://import-remote-profile?url={urllib.parse.quote(url)}#{j}"
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         "render.html", {"request": request, "j": j, "encoded_url": encoded_url}
     )
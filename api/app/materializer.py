@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import urllib.parse
+from typing import Dict, List, Optional, Set, Tuple
+
+from .delta import dumps, history, version_of
+from .prober import health
+from .shards import APP_SHARDS
+from .store import store
+from .utils import (
+    APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER,
+    APP_DEFAULT_DNS_DETOUR,
+    APP_DEFAULT_DNS_FINAL,
+    APP_DEFAULT_DNS_HOST,
+    APP_DEFAULT_DNS_PATH,
+    APP_DEFAULT_DNS_RESOLVER,
+    APP_DEFAULT_DNS_VERSION,
+    APP_DEFAULT_LOG_LEVEL,
+    APP_DEFAULT_ROUTE_DETOUR,
+    Reader,
+    UserRecord,
+    all_users,
+    list_route_rule_sets,
+    read_source,
+)
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+APP_MATERIALIZE: bool = os.getenv("APP_MATERIALIZE", "false") == "true"
+APP_MATERIALIZE_DIR = os.getenv("APP_MATERIALIZE_DIR", "/tmp/materialized")
+APP_MATERIALIZE_INTERVAL = int(os.getenv("APP_MATERIALIZE_INTERVAL", "30"))
+
+PLATFORMS = ("a", "i")
+VERSIONS = (11, 12)
+MULTIPLEX = (True, False)
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Helpers
+# -------------------------------------------------------------------
+
+
+def is_default_request(
+    log_level: str,
+    dns_host: str,
+    dns_path: str,
+    dns_detour: str,
+    dns_final: str,
+    dns_resolver: str,
+    dns_version: int,
+    default_domain_resolver: str,
+    route_detour: str,
+    custom_rule_sets: str,
+) -> bool:
+    """
+    Whether a `/c` request can be answered from a materialized file.
+    """
+    return (
+        log_level == APP_DEFAULT_LOG_LEVEL
+        and dns_host == APP_DEFAULT_DNS_HOST
+        and dns_path == APP_DEFAULT_DNS_PATH
+        and dns_detour == APP_DEFAULT_DNS_DETOUR
+        and dns_final == APP_DEFAULT_DNS_FINAL
+        and dns_resolver == APP_DEFAULT_DNS_RESOLVER
+        and dns_version == APP_DEFAULT_DNS_VERSION
+        and default_domain_resolver == APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER
+        and route_detour == APP_DEFAULT_ROUTE_DETOUR
+        and not custom_rule_sets
+    )
+
+
+def user_fingerprint(user: UserRecord) -> str:
+    return hashlib.sha256(
+        json.dumps(user.to_dict(), sort_keys=True).encode()
+    ).hexdigest()
+
+
+def variant_name(platform: str, version: int, multiplex: bool) -> str:
+    return f"{platform}{version}{'-mx' if multiplex else ''}.json.gz"
+
+
+# -------------------------------------------------------------------
+# Materializer
+# -------------------------------------------------------------------
+
+
+class Materializer:
+    """
+    Renders every default config to gzip files on disk.
+
+    The shared inputs (templates, route, outbounds, route rule listing,
+    outbound health ranking) are fingerprinted as a whole, users one by one.
+    A change to a shared input re-renders everything, a change to users only
+    touches those users.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.shared_fingerprint = ""
+        self.user_fingerprints: Dict[str, str] = {}
+        # (username, platform, version, multiplex) -> (path, password, config version)
+        self.files: Dict[Tuple[str, str, int, bool], Tuple[str, str, str]] = {}
+        self._lock = threading.Lock()
+
+        self.outbounds_path = os.getenv(
+            "APP_OUTBOUNDS_PATH", "test_data/outbounds.json"
+        )
+        self.users_data_path = os.getenv("APP_USERS_DATA_PATH", "test_data/users.jsonc")
+        self.route_path = os.getenv("APP_ROUTE_PATH", "test_data/route")
+        self.template_paths = [
+            os.getenv("APP_TEMPLATE_v12_PATH", "test_data/sing-box-template"),
+            os.getenv("APP_TEMPLATE_v11_PATH", "test_data/sing-box-template-v11"),
+        ]
+
+    # ------------------------------------------------------------------
+
+    def _shared_inputs(self) -> str:
+        digest = hashlib.sha256()
+        for source in [*self.template_paths, self.route_path, self.outbounds_path]:
+            digest.update(read_source(source)[1])
+        for name in list_route_rule_sets():
+            digest.update(name.encode())
+        digest.update(os.getenv("APP_DEFAULT_OTHER_RULE_SETS", "").encode())
+        digest.update(health.fingerprint().encode())
+        digest.update(str(APP_SHARDS).encode())
+        return digest.hexdigest()
+
+    def _user_dir(self, username: str) -> str:
+        return os.path.join(self.directory, urllib.parse.quote(username, safe=""))
+
+    def _render(self, user: UserRecord) -> None:
+        user_dir = self._user_dir(user.name)
+        os.makedirs(user_dir, exist_ok=True)
+
+        for platform in PLATFORMS:
+            for version in VERSIONS:
+                for multiplex in MULTIPLEX:
+                    config = Reader(
+                        username=user.name,
+                        psk=user.password,
+                        platform=platform,
+                        version=version,
+                        log_level=APP_DEFAULT_LOG_LEVEL,
+                        dns_host=APP_DEFAULT_DNS_HOST,
+                        dns_path=APP_DEFAULT_DNS_PATH,
+                        dns_detour=APP_DEFAULT_DNS_DETOUR,
+                        dns_final=APP_DEFAULT_DNS_FINAL,
+                        dns_resolver=APP_DEFAULT_DNS_RESOLVER,
+                        dns_version=APP_DEFAULT_DNS_VERSION,
+                        default_domain_resolver=APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER,
+                        route_detour=APP_DEFAULT_ROUTE_DETOUR,
+                        multiplex=multiplex,
+                        custom_rule_sets="",
+                        verify=False,
+                    ).unwarp()
+
+                    body = dumps(config)
+
+                    path = os.path.join(
+                        user_dir, variant_name(platform, version, multiplex)
+                    )
+                    tmp = f"{path}.tmp"
+                    with open(tmp, "wb") as f:
+                        f.write(gzip.compress(body, compresslevel=9, mtime=0))
+                    os.replace(tmp, path)
+
+                    with self._lock:
+                        self.files[(user.name, platform, version, multiplex)] = (
+                            path,
+                            user.password,
+                            version_of(body),
+                        )
+
+    def _drop(self, username: str) -> None:
+        with self._lock:
+            for key in [k for k in self.files if k[0] == username]:
+                del self.files[key]
+        shutil.rmtree(self._user_dir(username), ignore_errors=True)
+        history.forget(username)
+
+    # ------------------------------------------------------------------
+
+    def run(self) -> None:
+        """
+        Re-render whatever is stale. Safe to call as often as we like.
+        """
+        try:
+            shared = self._shared_inputs()
+            users = all_users(self.users_data_path)
+        except Exception as exc:
+            logger.warning("Materializer skipped, inputs unavailable: %s", exc)
+            return
+
+        full = shared != self.shared_fingerprint
+        stale: List[UserRecord] = []
+        for user in users.values():
+            fingerprint = user_fingerprint(user)
+            if full or self.user_fingerprints.get(user.name) != fingerprint:
+                stale.append(user)
+
+        removed = [name for name in self.user_fingerprints if name not in users]
+        for name in removed:
+            self._drop(name)
+            self.user_fingerprints.pop(name, None)
+
+        for user in stale:
+            try:
+                self._render(user)
+            except Exception as exc:
+                logger.warning("Failed to materialize configs for %s: %s", user.name, exc)
+                self._drop(user.name)
+                self.user_fingerprints.pop(user.name, None)
+                continue
+            self.user_fingerprints[user.name] = user_fingerprint(user)
+
+        self.shared_fingerprint = shared
+        if stale or removed:
+            logger.info(
+                "Materialized %d users, removed %d (%s)",
+                len(stale),
+                len(removed),
+                "full" if full else "incremental",
+            )
+
+    def invalidate(self, usernames: Set[str]) -> None:
+        """
+        Stop serving the files of changed users until they are re-rendered.
+        """
+        with self._lock:
+            for key in [k for k in self.files if k[0] in usernames]:
+                del self.files[key]
+        for name in usernames:
+            self.user_fingerprints.pop(name, None)
+
+    def lookup(
+        self, username: str, psk: str, platform: str, version: int, multiplex: bool
+    ) -> Optional[Tuple[str, str]]:
+        """
+        Path and config version of the materialized config, if there is one
+        for this PSK. The version is remembered for delta requests.
+        """
+        with self._lock:
+            entry = self.files.get((username, platform, version, multiplex))
+        if entry is None or entry[1] != psk:
+            return None
+
+        path, _, config_version = entry
+        if not history.has(username, config_version):
+            try:
+                with open(path, "rb") as f:
+                    history.record_compressed(username, config_version, f.read())
+            except FileNotFoundError:
+                return None
+        return path, config_version
+
+
+materializer = Materializer(APP_MATERIALIZE_DIR)
+if store is not None:
+    store.subscribe(materializer.invalidate)
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# The API container runs with `mem_limit: 128m`, see docker-compose.yaml.
+APP_LOW_MEMORY: bool = os.getenv("APP_LOW_MEMORY", "false") == "true"
+APP_CACHE_BUDGET_BYTES: int = int(
+    os.getenv(
+        "APP_CACHE_BUDGET_BYTES",
+        str(4 << 20) if APP_LOW_MEMORY else str(16 << 20),
+    )
+)
+# Jinja keeps parsed templates around, we only have a handful of them.
+TEMPLATE_CACHE_SIZE = 8 if APP_LOW_MEMORY else 64
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Byte budgeted LRU
+# -------------------------------------------------------------------
+
+
+class ByteLRU:
+    """
+    Thread safe LRU cache of `bytes` values, bounded by total size in bytes.
+
+    Values are raw bytes on purpose: callers parse a fresh copy on every hit,
+    so nothing mutable is ever shared between requests and the accounting
+    is exact.
+    """
+
+    __slots__ = ("name", "budget", "ttl", "size", "hits", "misses", "_data", "_lock")
+
+    def __init__(self, name: str, budget: int, ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.budget = budget
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(key: str, value: bytes) -> int:
+        return len(key) + len(value)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value = item
+            if expires and expires < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        cost = self._cost(key, value)
+        if cost > self.budget:
+            # Never let a single entry flush the whole cache.
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else 0.0
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (expires, value)
+            self.size += cost
+            while self.size > self.budget:
+                old_key, _ = next(iter(self._data.items()))
+                self._pop(old_key)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _pop(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= self._cost(key, item[1])
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "entries": len(self._data),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# -------------------------------------------------------------------
+# RSS
+# -------------------------------------------------------------------
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size of this process.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    import resource  # Not available on every platform, import lazily.
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def cgroup_limit_bytes() -> Optional[int]:
+    """
+    Memory limit of the container, if we are running inside one.
+    """
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path, "r", encoding="ascii") as f:
+                raw = f.read().strip()
+        except OSError:
+            continue
+        if raw.isdigit() and int(raw) < 1 << 60:
+            return int(raw)
+    return None
+
+
+def log_rss(stage: str) -> None:
+    rss = rss_bytes()
+    limit = cgroup_limit_bytes()
+    if limit:
+        logger.info(
+            "RSS at %s: %.1f MiB of %.1f MiB (%.0f%%), low memory mode: %s",
+            stage,
+            rss / (1 << 20),
+            limit / (1 << 20),
+            100 * rss / limit,
+            APP_LOW_MEMORY,
+        )
+    else:
+        logger.info(
+            "RSS at %s: %.1f MiB, low memory mode: %s",
+            stage,
+            rss / (1 << 20),
+            APP_LOW_MEMORY,
+        )
+
+
+# -------------------------------------------------------------------
+# Lazy templates
+# -------------------------------------------------------------------
+
+_templates: Any = None
+_templates_lock = threading.Lock()
+
+
+def get_templates() -> Any:
+    """
+    One shared Jinja2Templates for every router, built on first use.
+
+    Jinja is only needed by the HTML views, so `/c` only workers never pay
+    for importing it.
+    """
+    global _templates
+    if _templates is None:
+        with _templates_lock:
+            if _templates is None:
+                import jinja2
+                from fastapi.templating import Jinja2Templates
+
+                env = jinja2.Environment(
+                    loader=jinja2.FileSystemLoader("templates"),
+                    autoescape=True,
+                    cache_size=TEMPLATE_CACHE_SIZE,
+                )
+                _templates = Jinja2Templates(env=env)
+    return _templates
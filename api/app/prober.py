@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import ssl
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+APP_PROBE: bool = os.getenv("APP_PROBE", "false") == "true"
+APP_PROBE_INTERVAL = int(os.getenv("APP_PROBE_INTERVAL", "30"))
+APP_PROBE_TIMEOUT = float(os.getenv("APP_PROBE_TIMEOUT", "3"))
+# Rolling window of probes per outbound, and the success rate it must keep.
+APP_PROBE_WINDOW = int(os.getenv("APP_PROBE_WINDOW", "10"))
+APP_PROBE_MIN_SUCCESS = float(os.getenv("APP_PROBE_MIN_SUCCESS", "0.5"))
+# Outbounds are ranked on latency buckets this wide, not on raw latency.
+APP_PROBE_BUCKET_MS = float(os.getenv("APP_PROBE_BUCKET_MS", "50"))
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Health
+# -------------------------------------------------------------------
+
+
+class OutboundHealth:
+    """
+    Rolling probe results of one outbound, `None` latency means a failure.
+
+    `bucket` is the latency bucket it is ranked on. It only moves once the
+    latency is half a bucket past its edges, so jitter around an edge does
+    not reorder the groups and re-render every materialized config.
+    """
+
+    __slots__ = ("samples", "bucket")
+
+    def __init__(self) -> None:
+        self.samples: Deque[Optional[float]] = deque(maxlen=APP_PROBE_WINDOW)
+        self.bucket: Optional[int] = None
+
+    def record(self, latency: Optional[float]) -> None:
+        self.samples.append(latency)
+        mean = self.latency
+        if mean == float("inf"):
+            self.bucket = None
+        elif (
+            self.bucket is None
+            or abs(mean - (self.bucket + 0.5) * APP_PROBE_BUCKET_MS)
+            > APP_PROBE_BUCKET_MS
+        ):
+            self.bucket = int(mean // APP_PROBE_BUCKET_MS)
+
+    @property
+    def success_rate(self) -> float:
+        if not self.samples:
+            return 1.0
+        return sum(1 for s in self.samples if s is not None) / len(self.samples)
+
+    @property
+    def latency(self) -> float:
+        """
+        Mean handshake latency in ms of the successful probes.
+        """
+        ok = [s for s in self.samples if s is not None]
+        return sum(ok) / len(ok) if ok else float("inf")
+
+    @property
+    def healthy(self) -> bool:
+        return self.success_rate >= APP_PROBE_MIN_SUCCESS
+
+
+class HealthTable:
+    """
+    Health of every probed outbound, keyed by tag.
+
+    Outbounds that were never probed are considered healthy and sort after
+    the measured ones, so a fresh container serves the same groups as before.
+    """
+
+    def __init__(self) -> None:
+        self.outbounds: Dict[str, OutboundHealth] = {}
+
+    def record(self, tag: str, latency: Optional[float]) -> None:
+        self.outbounds.setdefault(tag, OutboundHealth()).record(latency)
+
+    def rank(self, tags: List[str]) -> List[str]:
+        """
+        Drop unhealthy tags and sort the rest by latency bucket, tags in
+        the same bucket keep their order.
+
+        Never returns an empty list for a non-empty input, an empty urltest
+        group is worse than one with dead members.
+        """
+        known = self.outbounds
+        alive = [t for t in tags if t not in known or known[t].healthy]
+        if not alive:
+            return list(tags)
+        return sorted(
+            alive,
+            key=lambda t: (
+                known[t].bucket
+                if t in known and known[t].bucket is not None
+                else float("inf")
+            ),
+        )
+
+    def fingerprint(self) -> str:
+        """
+        The healthy outbounds in bucket order. Changes only when the set of
+        healthy outbounds or their ranking does, not with every probe.
+        """
+        return ",".join(self.rank(sorted(self.outbounds)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            tag: {
+                "latency_ms": None if h.latency == float("inf") else round(h.latency, 1),
+                "success_rate": round(h.success_rate, 2),
+                "healthy": h.healthy,
+                "bucket": h.bucket,
+                "samples": len(h.samples),
+            }
+            for tag, h in self.outbounds.items()
+        }
+
+
+health = HealthTable()
+
+# -------------------------------------------------------------------
+# Probes
+# -------------------------------------------------------------------
+
+
+def probe_target(
+    outbound: Dict[str, Any], by_tag: Dict[str, Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """
+    The outbound that actually dials the server, following `detour`.
+    """
+    seen = set()
+    while outbound and not outbound.get("server"):
+        detour = outbound.get("detour")
+        if not detour or detour in seen:
+            return None
+        seen.add(detour)
+        outbound = by_tag.get(detour, {})
+    return outbound or None
+
+
+async def probe_outbound(
+    outbound: Dict[str, Any], timeout: float = APP_PROBE_TIMEOUT
+) -> Optional[float]:
+    """
+    TCP connect, plus a TLS handshake when the outbound uses TLS.
+
+    Returns the elapsed time in ms, or `None` when the server is unreachable.
+    The certificate is not verified, only the handshake is timed.
+    """
+    host = outbound["server"]
+    port = int(outbound.get("server_port") or 0)
+    tls = outbound.get("tls") or {}
+
+    context: Optional[ssl.SSLContext] = None
+    if tls.get("enabled"):
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    started = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port,
+                ssl=context,
+                server_hostname=(tls.get("server_name") or host) if context else None,
+            ),
+            timeout=timeout,
+        )
+    except (OSError, asyncio.TimeoutError, ssl.SSLError) as exc:
+        logger.debug("Probe %s:%s failed: %s", host, port, exc)
+        return None
+
+    elapsed = (time.perf_counter() - started) * 1000
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        pass
+    return elapsed
+
+
+async def probe_outbounds(outbounds: List[Dict[str, Any]]) -> None:
+    """
+    Probe every outbound once and record the results in `health`.
+
+    Outbounds sharing a dialing server, e.g. through the same `detour`,
+    share one probe.
+    """
+    by_tag = {ob.get("tag", ""): ob for ob in outbounds}
+    targets: Dict[Tuple[str, int], Tuple[Dict[str, Any], List[str]]] = {}
+
+    for ob in outbounds:
+        target = probe_target(ob, by_tag)
+        if not target or not target.get("server_port"):
+            continue
+        key = (target["server"], int(target["server_port"]))
+        targets.setdefault(key, (target, []))[1].append(ob.get("tag", ""))
+
+    results = await asyncio.gather(
+        *(probe_outbound(target) for target, _ in targets.values())
+    )
+    for (_, tags), latency in zip(targets.values(), results):
+        for tag in tags:
+            health.record(tag, latency)
+
+    logger.info("Probed %d outbounds: %s", len(by_tag), health.rank(sorted(by_tag)))
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import contextvars
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from types import FrameType
+from typing import Any, Dict, List, Optional
+
+from fastapi.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .logs import request_id
+from .utils import lookup_user
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+APP_PROFILE: bool = os.getenv("APP_PROFILE", "false") == "true"
+APP_PROFILE_PATHS = tuple(
+    x for x in os.getenv("APP_PROFILE_PATHS", "/c").split(",") if x
+)
+# Fraction of requests profiled without asking, 0 disables sampling.
+APP_PROFILE_SAMPLE_RATE = float(os.getenv("APP_PROFILE_SAMPLE_RATE", "0"))
+APP_PROFILE_INTERVAL_MS = float(os.getenv("APP_PROFILE_INTERVAL_MS", "5"))
+# Profiles kept in memory, and distinct stacks kept per profile.
+APP_PROFILE_KEEP = int(os.getenv("APP_PROFILE_KEEP", "20"))
+APP_PROFILE_MAX_STACKS = int(os.getenv("APP_PROFILE_MAX_STACKS", "2000"))
+PROFILE_HEADER = "x-profile"
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Profiles
+# -------------------------------------------------------------------
+
+
+class Profile:
+    """
+    Folded stacks of one request, the input format of flamegraph.pl and
+    speedscope.
+    """
+
+    __slots__ = (
+        "id",
+        "request_id",
+        "path",
+        "username",
+        "started",
+        "duration",
+        "thread_id",
+        "stacks",
+        "samples",
+        "psk",
+    )
+
+    def __init__(
+        self, request_id: str, path: str, username: str, psk: Optional[str] = None
+    ) -> None:
+        # Ours, `X-Request-Id` comes from the client and may repeat.
+        self.id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.path = path
+        self.username = username
+        # `k` of a requested profile, checked in `attach()`. None when sampled.
+        self.psk = psk
+        self.started = time.time()
+        self.duration = 0.0
+        self.thread_id: Optional[int] = None
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+
+    def add(self, frame: FrameType) -> None:
+        names: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+            frame = frame.f_back  # type: ignore
+        stack = ";".join(reversed(names))
+        if stack in self.stacks or len(self.stacks) < APP_PROFILE_MAX_STACKS:
+            self.stacks[stack] += 1
+        else:
+            self.stacks["[truncated]"] += 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "request_id": self.request_id,
+            "path": self.path,
+            "username": self.username,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 1),
+            "samples": self.samples,
+        }
+
+
+class Sampler:
+    """
+    One background thread sampling the threads of active profiles.
+
+    The thread only exists while a profile is running.
+    """
+
+    def __init__(self, interval: float, keep: int) -> None:
+        self.interval = interval
+        self.active: Dict[str, Profile] = {}
+        self.finished: OrderedDict[str, Profile] = OrderedDict()
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, profile: Profile) -> None:
+        with self._lock:
+            self.active[profile.id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, profile: Profile) -> None:
+        with self._lock:
+            self.active.pop(profile.id, None)
+            if profile.samples:
+                self.finished[profile.id] = profile
+                while len(self.finished) > self.keep:
+                    self.finished.popitem(last=False)
+
+    def _run(self) -> None:
+        while True:
+            frames = sys._current_frames()
+            # Under the lock, so a finished profile is never added to again.
+            with self._lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                for profile in self.active.values():
+                    frame = frames.get(profile.thread_id)  # type: ignore
+                    if frame is not None:
+                        profile.add(frame)
+            del frames
+            time.sleep(self.interval)
+
+
+sampler = Sampler(APP_PROFILE_INTERVAL_MS / 1000, APP_PROFILE_KEEP)
+_current: contextvars.ContextVar[Optional[Profile]] = contextvars.ContextVar(
+    "profile", default=None
+)
+
+
+def _is_admin(username: str, psk: str) -> bool:
+    user = lookup_user(
+        os.getenv("APP_USERS_DATA_PATH", "test_data/users.jsonc"), username
+    )
+    return bool(user and user.admin and user.password == psk)
+
+
+def attach() -> None:
+    """
+    Profile the calling thread if this request is being profiled.
+
+    Sync endpoints call this first thing, the threadpool copies the request's
+    context so the middleware's choice is visible here. Asked for profiles
+    are only started for admins, the user lookup may read a file or the
+    network so it runs here and not on the event loop.
+    """
+    if not APP_PROFILE:
+        return
+    profile = _current.get()
+    if profile is None:
+        return
+    if profile.psk is not None:
+        allowed = _is_admin(profile.username, profile.psk)
+        profile.psk = None
+        if not allowed:
+            return
+    profile.thread_id = threading.get_ident()
+    sampler.start(profile)
+
+
+# -------------------------------------------------------------------
+# Middleware
+# -------------------------------------------------------------------
+
+
+def _new_profile(request: Request, path: str) -> Optional[Profile]:
+    """
+    A profile for a sampled request, or for one asking with `X-Profile: 1`
+    that `attach()` still has to check.
+    """
+    rid = request_id.get()
+    username = request.query_params.get("j", "")
+    if APP_PROFILE_SAMPLE_RATE and random.random() < APP_PROFILE_SAMPLE_RATE:
+        return Profile(rid, path, username)
+    if request.headers.get(PROFILE_HEADER) != "1":
+        return None
+    return Profile(rid, path, username, request.query_params.get("k", ""))
+
+
+class ProfilerMiddleware:
+    """
+    Samples the stack of selected requests until the response starts.
+    The profile id is returned in `X-Profile-Id`.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in APP_PROFILE_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        profile = _new_profile(Request(scope), scope["path"])
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Sampling starts in `attach()`.
+        started = time.perf_counter()
+        token = _current.set(profile)
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                profile.duration = time.perf_counter() - started
+                sampler.stop(profile)
+                if profile.thread_id is not None:
+                    message.setdefault("headers", []).append(
+                        (b"x-profile-id", profile.id.encode("latin-1"))
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current.reset(token)
+            sampler.stop(profile)
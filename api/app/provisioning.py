@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from .breaker import CircuitBreaker, ssm_breaker, unavailable
+from .shards import APP_SHARDS, shard_of, ssm_prefix, ssm_prefixes
+from .store import store
+from .utils import APP_SSM_UPSTREAM, all_users
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# SSM API base URLs of every sing-box node, the first one serves stats.
+APP_SSM_NODES: List[str] = [
+    x.strip().rstrip("/")
+    for x in os.getenv("APP_SSM_NODES", APP_SSM_UPSTREAM).split(",")
+    if x.strip()
+]
+# Attempts per node, with jittered exponential backoff starting here.
+APP_PROVISION_RETRIES = int(os.getenv("APP_PROVISION_RETRIES", "3"))
+APP_PROVISION_BACKOFF = float(os.getenv("APP_PROVISION_BACKOFF", "0.5"))
+# Seconds between reconciliation runs, 0 disables them.
+APP_RECONCILE_INTERVAL = int(os.getenv("APP_RECONCILE_INTERVAL", "300"))
+# Delete users a node has but the store does not. Needs APP_USERS_DB, without
+# it `/create` writes users.json and the users file misses those users.
+APP_RECONCILE_PRUNE: bool = os.getenv("APP_RECONCILE_PRUNE", "false") == "true"
+# Requests in flight per node while repairing.
+RECONCILE_CONCURRENCY = 8
+HTTP_TIMEOUT = 5  # seconds
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Nodes
+# -------------------------------------------------------------------
+
+breakers: Dict[str, CircuitBreaker] = {
+    node: (
+        ssm_breaker
+        if node == APP_SSM_UPSTREAM.rstrip("/")
+        else CircuitBreaker(f"ssm:{node}")
+    )
+    for node in APP_SSM_NODES
+}
+
+
+async def _attempt(
+    node: str, fn: Callable[[], Awaitable[httpx.Response]]
+) -> httpx.Response:
+    """
+    Call `fn` through the node's breaker, retrying while the node is down.
+    """
+    delay = APP_PROVISION_BACKOFF
+    attempt = 1
+    while True:
+        try:
+            return await breakers[node].call_async(fn)
+        except httpx.HTTPError as exc:
+            if not unavailable(exc) or attempt >= APP_PROVISION_RETRIES:
+                raise
+            logger.warning("SSM node %s attempt %d failed: %s", node, attempt, exc)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay *= 2
+        attempt += 1
+
+
+async def upsert_user(
+    client: httpx.AsyncClient, node: str, username: str, upsk: str
+) -> None:
+    """
+    Create the user on one node, or set its uPSK if it already exists.
+    Safe to repeat. The user goes to the endpoint of its shard.
+    """
+    base = f"{node}{ssm_prefix(username)}/server/v1/users"
+
+    async def create() -> httpx.Response:
+        r = await client.post(base, json={"username": username, "uPSK": upsk})
+        if r.status_code not in (400, 409):
+            r.raise_for_status()
+        return r
+
+    async def update() -> httpx.Response:
+        r = await client.put(f"{base}/{username}", json={"uPSK": upsk})
+        r.raise_for_status()
+        return r
+
+    r = await _attempt(node, create)
+    if r.status_code in (400, 409):
+        # Already there, make sure the uPSK matches.
+        await _attempt(node, update)
+
+
+async def delete_user(
+    client: httpx.AsyncClient, node: str, prefix: str, username: str
+) -> None:
+    async def delete() -> httpx.Response:
+        r = await client.delete(f"{node}{prefix}/server/v1/users/{username}")
+        if r.status_code != 404:
+            r.raise_for_status()
+        return r
+
+    await _attempt(node, delete)
+
+
+# -------------------------------------------------------------------
+# Provisioning
+# -------------------------------------------------------------------
+
+
+async def provision(username: str, upsk: str) -> Dict[str, Optional[str]]:
+    """
+    Upsert a user on every node at once. Returns the error per node, None
+    where it succeeded. Nodes that failed are repaired by the reconciler.
+    """
+    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
+        results = await asyncio.gather(
+            *(upsert_user(client, node, username, upsk) for node in APP_SSM_NODES),
+            return_exceptions=True,
+        )
+    errors: Dict[str, Optional[str]] = {}
+    for node, result in zip(APP_SSM_NODES, results):
+        if isinstance(result, BaseException):
+            logger.error("Provisioning %s on %s failed: %s", username, node, result)
+            errors[node] = str(result) or type(result).__name__
+        else:
+            errors[node] = None
+    return errors
+
+
+# -------------------------------------------------------------------
+# Reconciliation
+# -------------------------------------------------------------------
+
+
+class Reconciler:
+    """
+    Brings every node's users in line with the users file or store.
+
+    Each node's `/server/v1/users` is diffed against the source of truth,
+    missing users and changed uPSKs are upserted in one bounded burst per
+    node. Users found on another shard's endpoint are moved, other extra
+    users are only deleted with `APP_RECONCILE_PRUNE` and the store.
+    """
+
+    def __init__(self) -> None:
+        self.last_run = 0.0
+        self.report: Dict[str, Dict[str, Any]] = {}
+        if APP_RECONCILE_PRUNE and store is None:
+            logger.warning("APP_RECONCILE_PRUNE needs APP_USERS_DB, not pruning")
+
+    async def _node(
+        self, client: httpx.AsyncClient, node: str, desired: Dict[str, str]
+    ) -> Dict[str, Any]:
+        async def listing(prefix: str) -> Dict[str, Optional[str]]:
+            async def get() -> httpx.Response:
+                r = await client.get(f"{node}{prefix}/server/v1/users")
+                r.raise_for_status()
+                return r
+
+            r = await _attempt(node, get)
+            return {u["username"]: u.get("uPSK") for u in r.json().get("users", [])}
+
+        prefixes = ssm_prefixes()
+        listings = await asyncio.gather(*(listing(p) for p in prefixes))
+        # Where each user is, and on which endpoint it should be.
+        actual = {u: psk for users in listings for u, psk in users.items()}
+        misplaced = [
+            (prefix, u)
+            for shard, (prefix, users) in enumerate(zip(prefixes, listings))
+            for u in users
+            if u in desired and APP_SHARDS > 1 and shard_of(u) != shard
+        ]
+        moved = {u for _, u in misplaced}
+
+        missing = [u for u in desired if u not in actual or u in moved]
+        changed = [
+            u
+            for u in desired
+            if u in actual and u not in moved and actual[u] != desired[u]
+        ]
+        extra = [
+            (prefix, u)
+            for prefix, users in zip(prefixes, listings)
+            for u in users
+            if u not in desired
+        ]
+
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+        async def bounded(coro: Any) -> None:
+            async with semaphore:
+                await coro
+
+        jobs = [
+            bounded(upsert_user(client, node, u, desired[u])) for u in missing + changed
+        ]
+        stale = misplaced + (extra if APP_RECONCILE_PRUNE and store is not None else [])
+        jobs += [bounded(delete_user(client, node, p, u)) for p, u in stale]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        failed = sum(isinstance(x, BaseException) for x in results)
+
+        if missing or changed or stale:
+            logger.info(
+                "Reconciled %s: %d missing, %d changed, %d moved, %d extra, %d failed",
+                node,
+                len(missing) - len(moved),
+                len(changed),
+                len(moved),
+                len(extra),
+                failed,
+            )
+        return {
+            "missing": len(missing) - len(moved),
+            "changed": len(changed),
+            "moved": len(moved),
+            "extra": len(extra),
+            "failed": failed,
+        }
+
+    async def run(self) -> Dict[str, Dict[str, Any]]:
+        source = os.getenv("APP_USERS_DATA_PATH", "test_data/users.jsonc")
+        users = await asyncio.to_thread(all_users, source)
+        desired = {name: u.password for name, u in users.items() if name}
+
+        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
+            results = await asyncio.gather(
+                *(self._node(client, node, desired) for node in APP_SSM_NODES),
+                return_exceptions=True,
+            )
+
+        report: Dict[str, Dict[str, Any]] = {}
+        for node, result in zip(APP_SSM_NODES, results):
+            if isinstance(result, BaseException):
+                logger.warning("Reconciling %s failed: %s", node, result)
+                report[node] = {"error": str(result) or type(result).__name__}
+            else:
+                report[node] = result
+        self.report = report
+        self.last_run = time.time()
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        return {"nodes": APP_SSM_NODES, "last_run": self.last_run, "report": self.report}
+
+
+reconciler = Reconciler()
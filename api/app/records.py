@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Optional
+
+
+class UserRecord:
+    """
+    One row of users.json, without the per-instance dict.
+    """
+
+    __slots__ = ("name", "password", "admin", "uuid")
+
+    def __init__(
+        self,
+        name: str,
+        password: str = "",
+        admin: bool = False,
+        uuid: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.password = password
+        self.admin = admin
+        self.uuid = uuid
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserRecord":
+        return cls(
+            name=data.get("name", ""),
+            password=data.get("password", ""),
+            admin=bool(data.get("admin", False)),
+            uuid=data.get("uuid"),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"name": self.name, "password": self.password}
+        if self.admin:
+            data["admin"] = True
+        if self.uuid:
+            data["uuid"] = self.uuid
+        return data
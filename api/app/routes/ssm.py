@@ -1,26 +1,31 @@
+import asyncio
 import json
 import os
 import secrets
 import string
 from typing import Any, Dict, List, Optional
 
-import httpx
-from app.utils import get_stats
+from app import breaker, logs, singleflight
+from app.admission import admission
+from app.memory import get_templates
+from app.profiler import sampler
+from app.prober import health
+from app.provisioning import provision, reconciler
+from app.records import UserRecord
+from app.shards import assign_inbound_users
+from app.store import store
+from app.delta import STALE_WARNING
+from app.live import broadcaster
+from app.utils import Stats, get_stats, lookup_user, sources
 from fastapi import APIRouter, Form, HTTPException
 from fastapi.requests import Request
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 
 router = APIRouter()
 
 APP_HOST: str = os.getenv("APP_HOST", "www.gstatic.com")
-START_PORT: int = int(os.getenv("START_PORT", "1080"))
-END_PORT: int = int(os.getenv("END_PORT", "1090"))
-
 APP_SSM_UPSTREAM = os.getenv("APP_SSM_UPSTREAM", "http://sing-box:8888")
 
-templates = Jinja2Templates(directory="templates")
-
 
 @router.get(
     "/server/v1/users",
@@ -28,9 +33,49 @@ templates = Jinja2Templates(directory="templates")
     response_class=HTMLResponse,
 )
 async def proxy_server_users(request: Request):
-    stats: List[Dict[str, Any]] = await get_stats()
-    return templates.TemplateResponse(
-        "users.html", {"request": request, "users": stats}
+    stats: Stats = await get_stats()
+    return get_templates().TemplateResponse(
+        "users.html",
+        {"request": request, "users": stats},
+        headers={"Warning": STALE_WARNING} if stats.stale else None,
+    )
+
+
+@router.get("/server/v1/users/live")
+async def live_server_users():
+    return StreamingResponse(
+        broadcaster.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/metrics")
+async def metrics():
+    return {
+        "singleflight": singleflight.stats(),
+        "caches": [sources.stats()],
+        "admission": admission.stats(),
+        "outbounds": health.stats(),
+        "logs": logs.stats(),
+        "breakers": breaker.stats(),
+        "reconciler": reconciler.stats(),
+    }
+
+
+@router.get("/profiles")
+async def list_profiles():
+    return [p.summary() for p in reversed(sampler.finished.values())]
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    profile = sampler.finished.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile.folded(),
+        headers={"Content-Disposition": f'attachment; filename="{profile.id}.folded"'},
     )
 
 
@@ -42,35 +87,47 @@ def create_upsk(custom_upsk: str | None):
     return "".join(secrets.choice(alphabet) for _ in range(20)) + "=="
 
 
-async def create_user_in_memory(username: str, uPSK: str):
-    async with httpx.AsyncClient(timeout=5) as client:
-        create_upstream = f"{APP_SSM_UPSTREAM}/server/v1/users"
-        payload = {"username": username, "uPSK": uPSK}
-        try:
-            r = await client.post(create_upstream, json=payload)
-            r.raise_for_status()
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=502, detail=f"Upstream error: {str(e)}")
+async def create_user_in_memory(username: str, uPSK: str) -> List[str]:
+    """
+    Provision every SSM node, returns the nodes that failed.
+    """
+    errors = await provision(username, uPSK)
+    failed = [node for node, error in errors.items() if error]
+    if len(failed) == len(errors):
+        raise HTTPException(
+            status_code=502, detail=f"Upstream error: {'; '.join(errors.values())}"
+        )
+    return failed
 
 
 async def create_user_in_file(username: str, uPSK: str):
+    if store is not None:
+        # users.json and inbounds.json are exported in the background.
+        store.upsert(UserRecord(username, uPSK))
+        return
+
     with open("/public/users.json", "r") as f:
         users = json.load(f)
     with open("/configs/inbounds.json", "r") as f:
         inbounds = json.load(f)
+    # Replace a row left by a concurrent create rather than adding a second.
+    users["users"] = [u for u in users["users"] if u.get("name") != username]
     users["users"].append({"name": username, "password": uPSK})
-    inbounds["inbounds"][-1]["users"] = [
-        {"name": u["name"], "password": u["password"]} for u in users["users"]
-    ]
+    assign_inbound_users(inbounds, [UserRecord.from_dict(u) for u in users["users"]])
     with open("/public/users.json", "w") as f:
         json.dump(users, f, indent=2)
     with open("/configs/inbounds.json", "w") as f:
         json.dump(inbounds, f, indent=2)
 
 
+@router.post("/reconcile")
+async def reconcile():
+    return await reconciler.run()
+
+
 @router.get("/form")
 async def get_form(request: Request):
-    return templates.TemplateResponse("form.html", {"request": request})
+    return get_templates().TemplateResponse("form.html", {"request": request})
 
 
 @router.post("/create")
@@ -81,14 +138,24 @@ async def create_user(
     platform: str = Form(...),
     version: str = Form(...),
 ):
+    # Provisioning upserts, it would rotate an existing user's uPSK everywhere.
+    source = os.getenv("APP_USERS_DATA_PATH", "test_data/users.jsonc")
+    if await asyncio.to_thread(lookup_user, source, username) is not None:
+        raise HTTPException(status_code=409, detail="User already exists")
+
     uPSK = create_upsk(custom_upsk)
 
-    await create_user_in_memory(username, uPSK)
+    failed = await create_user_in_memory(username, uPSK)
     await create_user_in_file(username, uPSK)
 
     import_url = f"https://{APP_HOST}/i?p={platform}&v={version}&j={username}&k={uPSK}"
     config_url = f"https://{APP_HOST}/c?p={platform}&v={version}&j={username}&k={uPSK}"
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         "form.html",
-        {"request": request, "import_url": import_url, "config_url": config_url},
+        {
+            "request": request,
+            "import_url": import_url,
+            "config_url": config_url,
+            "failed_nodes": failed,
+        },
     )
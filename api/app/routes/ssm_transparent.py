@@ -3,9 +3,6 @@ import os
 import httpx
 from fastapi import APIRouter, Request, Response
 
-START_PORT: int = int(os.getenv("START_PORT", "1080"))
-END_PORT: int = int(os.getenv("END_PORT", "1090"))
-
 APP_SSM_UPSTREAM = os.getenv("APP_SSM_UPSTREAM", "http://sing-box:8888")
 
 router = APIRouter()
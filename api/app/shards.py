@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import Any, Dict, Iterable, List, Tuple
+
+from .records import UserRecord
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+START_PORT: int = int(os.getenv("START_PORT", "1080"))
+END_PORT: int = int(os.getenv("END_PORT", "1090"))
+# shadowsocks/shadowtls inbound pairs users are spread over, 1 keeps the
+# single pair and the ports from outbounds.json.
+APP_SHARDS = int(os.getenv("APP_SHARDS", "1"))
+
+# With one shard the ports come from outbounds.json, the range is unused.
+if APP_SHARDS < 1 or (
+    APP_SHARDS > 1 and 2 * APP_SHARDS > END_PORT - START_PORT + 1
+):
+    raise ValueError(
+        f"APP_SHARDS={APP_SHARDS} does not fit in ports {START_PORT}-{END_PORT}"
+    )
+
+# -------------------------------------------------------------------
+# Placement
+# -------------------------------------------------------------------
+# `cli.py generate` has a copy of these, keep them in sync.
+
+
+def shard_of(username: str, shards: int = APP_SHARDS) -> int:
+    """
+    Rendezvous hashing: every user goes to the shard with the highest score.
+
+    Adding a shard only moves the users that now score highest on it,
+    removing one only moves that shard's users.
+    """
+    if shards <= 1:
+        return 0
+    return max(
+        range(shards),
+        key=lambda shard: hashlib.sha256(f"{shard}:{username}".encode()).digest()[:8],
+    )
+
+
+def ports(shard: int) -> Tuple[int, int]:
+    """
+    shadowsocks and shadowtls listen ports of a shard.
+    """
+    return START_PORT + 2 * shard, START_PORT + 2 * shard + 1
+
+
+def tag(base: str, shard: int) -> str:
+    return base if shard == 0 else f"{base}-{shard}"
+
+
+def shard_of_tag(inbound_tag: str) -> int:
+    suffix = inbound_tag.rsplit("-", 1)[-1]
+    return int(suffix) if "-" in inbound_tag and suffix.isdigit() else 0
+
+
+def ssm_endpoint(shard: int) -> str:
+    """
+    Path of the shard's shadowsocks inbound in the SSM API `servers` map.
+    """
+    return "/" if shard == 0 else f"/shard-{shard}"
+
+
+def ssm_prefix(username: str) -> str:
+    """
+    URL prefix of the SSM API endpoint managing `username`.
+    """
+    return ssm_endpoint(shard_of(username)).rstrip("/")
+
+
+def ssm_prefixes() -> List[str]:
+    return [ssm_endpoint(shard).rstrip("/") for shard in range(APP_SHARDS)]
+
+
+# -------------------------------------------------------------------
+# Configs
+# -------------------------------------------------------------------
+
+
+def assign_inbound_users(
+    inbounds: Dict[str, Any], users: Iterable[UserRecord]
+) -> None:
+    """
+    Give every shadowtls inbound in inbounds.json the users of its shard.
+    """
+    users = list(users)
+    for inbound in inbounds.get("inbounds", []):
+        if inbound.get("type") != "shadowtls":
+            continue
+        shard = shard_of_tag(inbound.get("tag", ""))
+        inbound["users"] = [
+            {"name": u.name, "password": u.password}
+            for u in users
+            if APP_SHARDS == 1 or shard_of(u.name) == shard
+        ]
+
+
+def shard_outbound(outbound: Dict[str, Any], username: str) -> None:
+    """
+    Point a server outbound at the user's shard. Detoured outbounds follow
+    their shadowtls outbound.
+    """
+    if APP_SHARDS == 1 or "server_port" not in outbound:
+        return
+    shadowsocks_port, shadowtls_port = ports(shard_of(username))
+    if outbound.get("type") == "shadowtls":
+        outbound["server_port"] = shadowtls_port
+    elif outbound.get("type") == "shadowsocks":
+        outbound["server_port"] = shadowsocks_port
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# -------------------------------------------------------------------
+# Metrics
+# -------------------------------------------------------------------
+
+groups: List["_Group"] = []
+
+
+class _Group:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+        groups.append(self)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+        }
+
+
+def stats() -> List[Dict[str, Any]]:
+    return [g.stats() for g in groups]
+
+
+# -------------------------------------------------------------------
+# Thread flavour
+# -------------------------------------------------------------------
+
+
+class WaitTimeout(Exception):
+    """
+    A caller gave up waiting on a call another caller is running.
+    """
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(_Group):
+    """
+    Concurrent calls with the same key share one execution of `fn`.
+
+    For the blocking code paths, e.g. `Reader` running in the threadpool.
+    Every waiter gets the same result object, so results must be treated
+    as read-only.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], T], timeout: Optional[float] = None) -> T:
+        """
+        Run `fn` or join the running call for `key`. A caller that joins
+        waits at most `timeout` seconds, the call goes on for the others.
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise WaitTimeout(f"{self.name}: gave up waiting on {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+# -------------------------------------------------------------------
+# Asyncio flavour
+# -------------------------------------------------------------------
+
+
+class AsyncSingleFlight(_Group):
+    """
+    Same as `SingleFlight`, for coroutines running on the event loop.
+
+    The shared call runs as its own task, so one caller being cancelled
+    does not cancel it for the others.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._tasks: Dict[str, "asyncio.Task[Any]"] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+        task = self._tasks.get(key)
+        if task is None:
+            self.executed += 1
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .shards import APP_SHARDS, ssm_endpoint
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# sing-box persists SSM counters here, see `cache/ssm-cache.json` in scaffolds.
+APP_SSM_CACHE_PATH = os.getenv("APP_SSM_CACHE_PATH", "/cache/ssm-cache.json")
+# Sharded setups read the endpoint of every shard instead.
+APP_SSM_CACHE_ENDPOINT = os.getenv("APP_SSM_CACHE_ENDPOINT", "/")
+
+# ssm-cache.json key -> SSM API field
+COUNTERS = {
+    "user_uplink": "uplinkBytes",
+    "user_downlink": "downlinkBytes",
+    "user_uplink_packets": "uplinkPackets",
+    "user_downlink_packets": "downlinkPackets",
+    "user_tcp_sessions": "tcpSessions",
+    "user_udp_sessions": "udpSessions",
+}
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Reader
+# -------------------------------------------------------------------
+
+
+class SSMCache:
+    """
+    Read-only view of sing-box's ssm-cache.json, for when the SSM API is down.
+
+    The file is parsed again, in full, only when its mtime or size changes.
+    Rows of users whose counters did not change are kept as they are, so
+    callers holding on to them see consistent objects between reloads.
+
+    Rows look like the SSM API's user objects: `username`, `uPSK` and the
+    counters from `COUNTERS`.
+    """
+
+    def __init__(self, path: str, endpoints: List[str]) -> None:
+        self.path = path
+        self.endpoints = endpoints
+        self.signature: Tuple[int, int] = (0, 0)
+        self.mtime = 0.0
+        self.rows: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _parse(self) -> List[Dict[str, Any]]:
+        with open(self.path, "rb") as f:
+            data = json.load(f)
+        endpoints = data.get("endpoints", {})
+        return [endpoints.get(e, {}) for e in self.endpoints]
+
+    def refresh(self) -> bool:
+        """
+        Reload the file if it changed. Returns whether any rows are available.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return bool(self.rows)
+
+        signature = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if signature == self.signature:
+                return bool(self.rows)
+
+            try:
+                endpoints = self._parse()
+            except (OSError, ValueError) as exc:
+                # sing-box may be halfway through writing it, try next time.
+                logger.warning("Failed to read %s: %s", self.path, exc)
+                return bool(self.rows)
+
+            rows: Dict[str, Dict[str, Any]] = {}
+            for endpoint in endpoints:
+                psks: Dict[str, str] = endpoint.get("users", {})
+                for username, psk in psks.items():
+                    row = {"username": username, "uPSK": psk}
+                    for key, field in COUNTERS.items():
+                        row[field] = endpoint.get(key, {}).get(username, 0)
+                    old = self.rows.get(username)
+                    rows[username] = old if old == row else row
+
+            self.rows = rows
+            self.signature = signature
+            self.mtime = st.st_mtime
+            logger.info("Loaded %d users from %s", len(rows), self.path)
+            return bool(rows)
+
+    def users(self) -> List[Dict[str, Any]]:
+        self.refresh()
+        return list(self.rows.values())
+
+    def user(self, username: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        return self.rows.get(username)
+
+
+offline = SSMCache(
+    APP_SSM_CACHE_PATH,
+    (
+        [APP_SSM_CACHE_ENDPOINT]
+        if APP_SHARDS == 1
+        else [ssm_endpoint(shard) for shard in range(APP_SHARDS)]
+    ),
+)
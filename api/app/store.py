@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Callable, Iterable, List, Optional, Set
+
+from .records import UserRecord
+from .shards import assign_inbound_users
+
+# -------------------------------------------------------------------
+# Environment & Constants
+# -------------------------------------------------------------------
+
+# Empty keeps the users.json(c) file as the source of truth.
+APP_USERS_DB = os.getenv("APP_USERS_DB", "")
+# Exported for sing-box and `cli.py generate`, both still read JSON.
+APP_USERS_EXPORT_PATH = os.getenv("APP_USERS_EXPORT_PATH", "/public/users.json")
+APP_INBOUNDS_PATH = os.getenv("APP_INBOUNDS_PATH", "/configs/inbounds.json")
+APP_USERS_EXPORT_INTERVAL = int(os.getenv("APP_USERS_EXPORT_INTERVAL", "10"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    admin INTEGER NOT NULL DEFAULT 0,
+    uuid TEXT
+) WITHOUT ROWID;
+"""
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Store
+# -------------------------------------------------------------------
+
+
+class UserStore:
+    """
+    Users in SQLite, keyed by name.
+
+    The primary key is the B-tree index, so lookups are O(log n) and adding
+    a user is one row instead of a rewritten file. Every thread gets its
+    own connection, WAL lets readers run next to the writer.
+
+    Writers notify subscribers with the changed names after the commit.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._dirty = False
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+
+    def get(self, name: str) -> Optional[UserRecord]:
+        row = (
+            self._conn()
+            .execute("SELECT name, password, admin, uuid FROM users WHERE name = ?", (name,))
+            .fetchone()
+        )
+        return UserRecord(row[0], row[1], bool(row[2]), row[3]) if row else None
+
+    def all(self) -> List[UserRecord]:
+        rows = self._conn().execute(
+            "SELECT name, password, admin, uuid FROM users ORDER BY name"
+        )
+        return [UserRecord(r[0], r[1], bool(r[2]), r[3]) for r in rows]
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT count(*) FROM users").fetchone()[0]
+
+    def upsert_many(self, users: Iterable[UserRecord]) -> None:
+        """
+        Insert or update users in one transaction.
+        """
+        rows = [(u.name, u.password, int(u.admin), u.uuid) for u in users]
+        if not rows:
+            return
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO users (name, password, admin, uuid) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET password = excluded.password, "
+                "admin = excluded.admin, uuid = excluded.uuid",
+                rows,
+            )
+        self._notify({r[0] for r in rows})
+
+    def upsert(self, user: UserRecord) -> None:
+        self.upsert_many([user])
+
+    def delete(self, name: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM users WHERE name = ?", (name,))
+        self._notify({name})
+
+    # ------------------------------------------------------------------
+
+    def subscribe(self, listener: Callable[[Set[str]], None]) -> None:
+        self._listeners.append(listener)
+
+    def _notify(self, names: Set[str]) -> None:
+        self._dirty = True
+        for listener in self._listeners:
+            try:
+                listener(names)
+            except Exception as exc:
+                logger.warning("User store listener failed: %s", exc)
+
+    # ------------------------------------------------------------------
+
+    def import_json(self, path: str) -> int:
+        """
+        Seed an empty store from a users.json file.
+        """
+        if self.count() or not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            users = [UserRecord.from_dict(u) for u in json.load(f).get("users", [])]
+        self.upsert_many(users)
+        logger.info("Imported %d users from %s", len(users), path)
+        return len(users)
+
+    def export(self, force: bool = False) -> None:
+        """
+        Write users.json and the users of every shadowtls inbound in
+        inbounds.json.
+
+        Runs from the scheduler, so a burst of new users costs one export.
+        """
+        if not (self._dirty or force):
+            return
+        self._dirty = False
+
+        users = self.all()
+        _write_json(APP_USERS_EXPORT_PATH, {"users": [u.to_dict() for u in users]})
+
+        try:
+            with open(APP_INBOUNDS_PATH, "r") as f:
+                inbounds = json.load(f)
+        except (OSError, ValueError) as exc:
+            logger.warning("Skipped inbounds export: %s", exc)
+            return
+        assign_inbound_users(inbounds, users)
+        _write_json(APP_INBOUNDS_PATH, inbounds)
+        logger.info("Exported %d users", len(users))
+
+
+def _write_json(path: str, data: object) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Single file bind mounts can not be replaced, write in place instead.
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.unlink(tmp)
+
+
+store: Optional[UserStore] = UserStore(APP_USERS_DB) if APP_USERS_DB else None
@@ -4,13 +4,26 @@ import asyncio
 import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 import httpx
 from fastapi import HTTPException
 
+from .breaker import github_breaker, jsdelivr_breaker, ssm_breaker, unavailable
+from .deadline import Deadline, DeadlineExceeded
+from .memory import APP_CACHE_BUDGET_BYTES, ByteLRU
+from .prober import health
+from .records import UserRecord
+from .shards import shard_outbound, ssm_prefix, ssm_prefixes
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .ssm_cache import offline
+from .store import store
+
 # -------------------------------------------------------------------
 # Environment & Constants
 # -------------------------------------------------------------------
@@ -24,15 +37,42 @@ APP_SSM_UPSTREAM = os.getenv("APP_SSM_UPSTREAM", "http://sing-box:8888")
 
 APP_DEFAULT_QUOTA_IN_BYTES = int(os.getenv("APP_DEFAULT_QUOTA_IN_BYTES", "30000000000"))
 HTTP_TIMEOUT = 5  # seconds
+# Remote templates and routes are re-fetched after this many seconds.
+APP_SOURCE_TTL = int(os.getenv("APP_SOURCE_TTL", "60"))
+# Unauthenticated GitHub API calls are limited to 60 per hour.
+APP_GITHUB_TTL = int(os.getenv("APP_GITHUB_TTL", "300"))
+# Overridden by `loadtest.py fleet` to point at its local stand-ins.
+APP_GITHUB_API = os.getenv("APP_GITHUB_API", "https://api.github.com")
+APP_JSDELIVR_URL = os.getenv("APP_JSDELIVR_URL", "https://cdn.jsdelivr.net")
+
+# Default query parameters of `/c`
+APP_DEFAULT_PLATFORM = os.getenv("APP_DEFAULT_PLATFORM", "a")
+APP_DEFAULT_VERSION = int(os.getenv("APP_DEFAULT_VERSION", 12))
+APP_DEFAULT_LOG_LEVEL = os.getenv("APP_DEFAULT_LOG_LEVEL", "warn")
+APP_DEFAULT_DNS_HOST = os.getenv("APP_DEFAULT_DNS_HOST", "dns.nextdns.io")
+APP_DEFAULT_DNS_PATH = os.getenv("APP_DEFAULT_DNS_PATH", "/")
+APP_DEFAULT_DNS_DETOUR = os.getenv("APP_DEFAULT_DNS_DETOUR", "Out")
+APP_DEFAULT_DNS_FINAL = os.getenv("APP_DEFAULT_DNS_FINAL", "dns-remote")
+APP_DEFAULT_DNS_RESOLVER = os.getenv("APP_DEFAULT_DNS_RESOLVER", "1.1.1.1")
+APP_DEFAULT_DNS_VERSION = int(os.getenv("APP_DEFAULT_DNS_VERSION", 4))
+APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER = os.getenv(
+    "APP_DEFAULT_DEFAULT_DOMAIN_RESOLVER", "dns-remote"
+)
+APP_DEFAULT_ROUTE_DETOUR = os.getenv("APP_DEFAULT_ROUTE_DETOUR", "Out")
+APP_DEFAULT_MULTIPLEX_ENABLED = os.getenv("APP_DEFAULT_MULTIPLEX_ENABLED") == "true"
+
+ROUTE_RULES_OWNER = "minlaxz"
+ROUTE_RULES_REPO = "nekohasekai"
+ROUTE_RULES_BRANCH = "route-rules"
+# Written by rules/build.py, lists the content-addressed rule set shards.
+ROUTE_RULES_MANIFEST = "manifest.json"
+
+ZONE = ZoneInfo("Asia/Yangon")
 
 # -------------------------------------------------------------------
 # Logging
 # -------------------------------------------------------------------
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
 # -------------------------------------------------------------------
@@ -40,20 +80,260 @@ logger = logging.getLogger(__name__)
 # -------------------------------------------------------------------
 
 
-def load_json(source: str) -> Dict[str, Any]:
+sources = ByteLRU("sources", APP_CACHE_BUDGET_BYTES, ttl=APP_SOURCE_TTL)
+
+# Concurrent identical upstream calls share one request.
+github_flight = SingleFlight("github")
+ssm_flight = SingleFlight("ssm")
+rule_set_flight = SingleFlight("rule_sets")
+stats_flight = AsyncSingleFlight("stats")
+
+# Last-known-good upstream answers, served while a circuit is open.
+# Remote sources are a handful of configured URLs, the others are bounded.
+LAST_GOOD_ENTRIES = 1024
+last_good_sources: Dict[str, bytes] = {}
+last_good_users: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+last_good_heads: "OrderedDict[str, int]" = OrderedDict()
+last_good_stats: Optional["Stats"] = None
+_last_good_lock = threading.Lock()
+
+
+def _remember(table: "OrderedDict[str, Any]", key: str, value: Any) -> None:
+    with _last_good_lock:
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > LAST_GOOD_ENTRIES:
+            table.popitem(last=False)
+
+
+def _fetch(url: str, timeout: float = HTTP_TIMEOUT) -> bytes:
+    response = httpx.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def read_source(source: str, ttl: Optional[float] = None) -> Tuple[str, bytes]:
     """
-    Load JSON from a local file or HTTP(S) URL.
+    Read raw bytes from a local file or HTTP(S) URL through the source cache.
+
+    Returns the cache key together with the bytes, local files are keyed on
+    their mtime so an edit is picked up on the next request.
     """
     if source.startswith(("http://", "https://")):
-        response = httpx.get(source, timeout=HTTP_TIMEOUT)
-        response.raise_for_status()
-        return response.json()
+        key = source
+        raw = sources.get(key)
+        if raw is None:
+            try:
+                raw = github_flight.do(
+                    key, lambda: github_breaker.call(lambda: _fetch(source))
+                )
+            except httpx.HTTPError as exc:
+                if not unavailable(exc) or key not in last_good_sources:
+                    raise
+                logger.warning("Serving last known good %s: %s", source, exc)
+                return key, last_good_sources[key]
+            sources.put(key, raw, ttl=ttl)
+            last_good_sources[key] = raw
+        return key, raw
 
-    if not os.path.exists(source):
+    try:
+        key = f"{source}@{os.stat(source).st_mtime_ns}"
+    except FileNotFoundError:
         raise FileNotFoundError(f"JSON source not found: {source}")
 
-    with open(source, "r", encoding="utf-8") as f:
-        return json.load(f)
+    raw = sources.get(key)
+    if raw is None:
+        with open(source, "rb") as f:
+            raw = f.read()
+        # Local files never expire, the key changes with the mtime instead.
+        sources.put(key, raw, ttl=0)
+    return key, raw
+
+
+def optional_source(
+    source: str, ttl: Optional[float], deadline: Deadline, part: str
+) -> Optional[bytes]:
+    """
+    A remote source the config can do without. Fetched within what is left
+    of the budget, otherwise the last known good copy or None, and `part`
+    is reported as degraded.
+    """
+    raw = sources.get(source)
+    if raw is not None:
+        return raw
+    if not deadline.exhausted():
+        try:
+            raw = deadline.join(
+                github_flight,
+                source,
+                lambda: github_breaker.call(
+                    lambda: deadline.call(lambda t: _fetch(source, t), HTTP_TIMEOUT)
+                ),
+            )
+        except httpx.HTTPError as exc:
+            logger.warning("Degrading %s, %s unavailable: %s", part, source, exc)
+        else:
+            sources.put(source, raw, ttl=ttl)
+            last_good_sources[source] = raw
+            return raw
+    deadline.degrade(part)
+    return last_good_sources.get(source)
+
+
+def load_json(source: str) -> Dict[str, Any]:
+    """
+    Load JSON from a local file or HTTP(S) URL.
+
+    Every call returns a freshly parsed document, callers are free to mutate it.
+    """
+    return json.loads(read_source(source)[1])
+
+
+def list_route_rule_sets(deadline: Optional[Deadline] = None) -> List[str]:
+    """
+    Names of the compiled `.srs` files on the route-rules branch.
+
+    The shards in the manifest when there is one, so a rule change only
+    renames the shards it touched. Otherwise, or when the manifest is out
+    of budget, the full rule sets.
+
+    Optional under a deadline, no names if there is no listing to fall
+    back on.
+    """
+
+    def read(url: str) -> Optional[bytes]:
+        if deadline is None:
+            return read_source(url, ttl=APP_GITHUB_TTL)[1]
+        return optional_source(url, APP_GITHUB_TTL, deadline, "route_rule_sets")
+
+    api_url = (
+        f"{APP_GITHUB_API}/repos/{ROUTE_RULES_OWNER}/{ROUTE_RULES_REPO}"
+        f"/contents?ref={ROUTE_RULES_BRANCH}"
+    )
+    raw = read(api_url)
+    if raw is None:
+        return []
+    files = json.loads(raw)
+    manifest = next((f for f in files if f["name"] == ROUTE_RULES_MANIFEST), None)
+    raw = read(manifest["download_url"]) if manifest else None
+    if raw is None:
+        # Shards are named `<list>-<bucket>-<hash>.srs`, full rule sets
+        # `<list>.srs` from `*-rules.json`.
+        return [
+            f["name"]
+            for f in files
+            if f["name"].endswith("-rules.srs" if manifest else ".srs")
+        ]
+    return [
+        shard["file"]
+        for rule_set in json.loads(raw)["rule_sets"].values()
+        for shard in rule_set["shards"]
+    ]
+
+
+def fetch_user(upstream: str, username: str) -> Dict[str, Any]:
+    """
+    One user from the SSM API. The result is shared, do not mutate it.
+    """
+    url = f"{upstream}{ssm_prefix(username)}/server/v1/users/{username}"
+
+    def fetch() -> Dict[str, Any]:
+        data = ssm_breaker.call(lambda: json.loads(_fetch(url)))
+        _remember(last_good_users, username, (time.time(), data))
+        return data
+
+    return ssm_flight.do(url, fetch)
+
+
+def ssm_unavailable(exc: Exception) -> bool:
+    """
+    Whether the SSM API is down or restarting, as opposed to saying no.
+    """
+    return unavailable(exc)
+
+
+def last_known_user(username: str) -> Optional[Dict[str, Any]]:
+    """
+    The fresher of the last SSM API answer and ssm-cache.json for a user.
+    """
+    remembered = last_good_users.get(username)
+    cached = offline.user(username)
+    if remembered is None:
+        return cached
+    if cached is None or remembered[0] >= offline.mtime:
+        return remembered[1]
+    return cached
+
+
+def verify_user(upstream: str, username: str, psk: str) -> Tuple[bool, bool]:
+    """
+    Check the PSK and the quota of a user against the SSM API.
+
+    Falls back to sing-box's ssm-cache.json while the API is unavailable.
+    Returns whether the user is verified and whether the cache was used.
+    """
+    stale = False
+    try:
+        try:
+            data = fetch_user(upstream, username)
+        except Exception as exc:
+            cached = last_known_user(username) if ssm_unavailable(exc) else None
+            if cached is None:
+                raise
+            logger.warning("SSM API unavailable (%s), using last known user", exc)
+            data, stale = cached, True
+
+        if data.get("uPSK") != psk:
+            raise ValueError("User or PSK mismatch")
+
+        used_bytes = data.get("uplinkBytes", 0) + data.get("downlinkBytes", 0)
+        if used_bytes > APP_DEFAULT_QUOTA_IN_BYTES:
+            raise ValueError("Quota exceeded")
+
+        logger.info("User %s verified successfully", username)
+        return True, stale
+
+    except Exception as exc:
+        logger.error("User verification failed: %s", exc)
+        return False, stale
+
+
+def _head(url: str, deadline: Optional[Deadline] = None) -> int:
+    """
+    Status of a HEAD request to jsDelivr, the last known one while it is down.
+    """
+
+    def head(timeout: float = HTTP_TIMEOUT) -> int:
+        response = httpx.head(url, timeout=timeout)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response.status_code
+
+    try:
+        status_code = jsdelivr_breaker.call(
+            (lambda: deadline.call(head, HTTP_TIMEOUT)) if deadline else head
+        )
+    except httpx.HTTPError as exc:
+        if not unavailable(exc) or url not in last_good_heads:
+            raise
+        logger.warning("Using last known status of %s: %s", url, exc)
+        return last_good_heads[url]
+    _remember(last_good_heads, url, status_code)
+    return status_code
+
+
+def _head_within(url: str, deadline: Deadline) -> Optional[int]:
+    """
+    `_head` within what is left of the budget, otherwise the last known
+    status, None if there is none.
+    """
+    if not deadline.exhausted():
+        try:
+            return deadline.join(rule_set_flight, url, lambda: _head(url, deadline))
+        except DeadlineExceeded as exc:
+            logger.warning("Using last known status of %s: %s", url, exc)
+    deadline.degrade("rule_set_checks")
+    return last_good_heads.get(url)
 
 
 def head_and_fetch(
@@ -63,18 +343,22 @@ def head_and_fetch(
     geosite_rule_sets: List[Any] = [],
     route_detour: Optional[str] = None,
     skip_head: bool = False,
+    deadline: Optional[Deadline] = None,
 ) -> None:
     """
     Check if a remote rule set exists by sending a HEAD request.
+
+    Once the deadline is spent the last known status is trusted, a rule set
+    never checked before is left out.
     """
     rule_set = rule_set.strip().lower()
 
     if not rule_set:
         return
 
-    url = f"https://cdn.jsdelivr.net/gh/MetaCubeX/meta-rules-dat@sing/geo/geosite/{rule_set}.srs"
+    url = f"{APP_JSDELIVR_URL}/gh/MetaCubeX/meta-rules-dat@sing/geo/geosite/{rule_set}.srs"
     if "ip-" in rule_set:
-        url = f"https://cdn.jsdelivr.net/gh/MetaCubeX/meta-rules-dat@sing/geo/geoip/{rule_set.replace('ip-', '')}.srs"
+        url = f"{APP_JSDELIVR_URL}/gh/MetaCubeX/meta-rules-dat@sing/geo/geoip/{rule_set.replace('ip-', '')}.srs"
 
     try:
         if skip_head:
@@ -91,8 +375,13 @@ def head_and_fetch(
             else:
                 geosite_rule_sets.append(rule_set)
         else:
-            response = httpx.head(url, timeout=HTTP_TIMEOUT)
-            if response.status_code == 200:
+            if deadline is None:
+                status_code = rule_set_flight.do(url, lambda: _head(url))
+            else:
+                status_code = _head_within(url, deadline)
+                if status_code is None:
+                    return
+            if status_code == 200:
                 rule_sets.append({
                     "tag": rule_set,
                     "type": "remote",
@@ -106,7 +395,101 @@ def head_and_fetch(
             else:
                 geosite_rule_sets.append(rule_set)
     except httpx.HTTPError as e:
-        logger.warning(f"Failed to check rule set {rule_set}: {e}")
+        if deadline is not None:
+            deadline.degrade("rule_set_checks")
+        logger.warning("Failed to check rule set %s: %s", rule_set, e)
+
+
+# -------------------------------------------------------------------
+# Records
+# -------------------------------------------------------------------
+
+
+class StatsRow:
+    """
+    Per user counters from the SSM API, joined with the user's uPSK.
+
+    The human readable columns are computed on access instead of being
+    stored next to the raw counters.
+    """
+
+    __slots__ = (
+        "username",
+        "uPSK",
+        "uplinkBytes",
+        "downlinkBytes",
+        "uplinkPackets",
+        "downlinkPackets",
+        "tcpSessions",
+        "udpSessions",
+    )
+
+    def __init__(self, data: Dict[str, Any], uPSK: Optional[str] = None) -> None:
+        self.username: str = data["username"]
+        self.uPSK = uPSK
+        self.uplinkBytes: int = data.get("uplinkBytes", 0)
+        self.downlinkBytes: int = data.get("downlinkBytes", 0)
+        self.uplinkPackets: int = data.get("uplinkPackets", 0)
+        self.downlinkPackets: int = data.get("downlinkPackets", 0)
+        self.tcpSessions: int = data.get("tcpSessions", 0)
+        self.udpSessions: int = data.get("udpSessions", 0)
+
+    @property
+    def uplinkBytesHuman(self) -> str:
+        return format_bytes(self.uplinkBytes)
+
+    @property
+    def downlinkBytesHuman(self) -> str:
+        return format_bytes(self.downlinkBytes)
+
+    @property
+    def uplinkPacketsHuman(self) -> str:
+        return format_packets(self.uplinkPackets)
+
+    @property
+    def downlinkPacketsHuman(self) -> str:
+        return format_packets(self.downlinkPackets)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"StatsRow({self.username!r}, down={self.downlinkBytesHuman})"
+
+
+_users_index: Tuple[str, Dict[str, UserRecord]] = ("", {})
+
+
+def load_users(source: str) -> Dict[str, UserRecord]:
+    """
+    Users keyed by name, parsed once per version of the users file.
+
+    The returned mapping is shared between requests and must not be mutated.
+    """
+    global _users_index
+    key, raw = read_source(source)
+    if _users_index[0] != key:
+        users = json.loads(raw).get("users", [])
+        _users_index = (
+            key,
+            {u.get("name", ""): UserRecord.from_dict(u) for u in users},
+        )
+    return _users_index[1]
+
+
+def lookup_user(source: str, username: str) -> Optional[UserRecord]:
+    """
+    One user, from the SQLite store when enabled, otherwise from `source`.
+    """
+    if store is not None:
+        return store.get(username)
+    return load_users(source).get(username)
+
+
+def all_users(source: str) -> Dict[str, UserRecord]:
+    if store is not None:
+        return {u.name: u for u in store.all()}
+    return load_users(source)
 
 
 # -------------------------------------------------------------------
@@ -121,12 +504,16 @@ class Checker:
         psk: str,
         platform: str,
         version: int,
+        verify: bool = True,
     ) -> None:
         self.username = username
         self.psk = psk
         self.platform = platform
         self.version = version
         self.admin_mode = False
+        # Verified from ssm-cache.json instead of the SSM API
+        self.stale = False
+        self.verified = False
 
         self.app_ssm_upstream = os.getenv("APP_SSM_UPSTREAM", "http://sing-box:8888")
         self.outbounds_path = os.getenv(
@@ -143,41 +530,21 @@ class Checker:
 
         self.template_data: Dict[str, Any] = {}
         self.outbounds_data: Dict[str, Any] = {}
-        self.users_data: Dict[str, Any] = {}
+        self.user: Optional[UserRecord] = None
 
-        self._verify_user()
+        if verify:
+            self._verify_user()
         self._load_criticals()
 
-        self.admin_mode = next(
-            (
-                u.get("admin", False)
-                for u in self.users_data.get("users", [])
-                if u.get("name") == self.username
-            ),
-            False,
-        )
+        self.admin_mode = self.user.admin if self.user else False
 
     # ------------------------------------------------------------------
 
     def _verify_user(self) -> None:
-        url = f"{self.app_ssm_upstream}/server/v1/users/{self.username}"
-
-        try:
-            response = httpx.get(url, timeout=HTTP_TIMEOUT)
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get("uPSK") != self.psk:
-                raise ValueError("User or PSK mismatch")
-
-            used_bytes = data.get("uplinkBytes", 0) + data.get("downlinkBytes", 0)
-            if used_bytes > APP_DEFAULT_QUOTA_IN_BYTES:
-                raise ValueError("Quota exceeded")
-
-            logger.info("User %s verified successfully", self.username)
-
-        except Exception as exc:
-            logger.error("User verification failed: %s", exc)
+        self.verified, self.stale = verify_user(
+            self.app_ssm_upstream, self.username, self.psk
+        )
+        if not self.verified:
             # Invalidate PSK to prevent config generation
             self.psk = "invalid_psk"
 
@@ -189,7 +556,7 @@ class Checker:
         self.template_data["route"] = route_data.get("route", {})
 
         self.outbounds_data = load_json(self.outbounds_path)
-        self.users_data = load_json(self.users_data_path)
+        self.user = lookup_user(self.users_data_path, self.username)
 
         if not self.template_data:
             raise RuntimeError("Template data is empty")
@@ -220,8 +587,10 @@ class Reader(Checker):
         route_detour: str,
         custom_rule_sets: str,
         multiplex: bool,
+        verify: bool = True,
+        deadline: Optional[Deadline] = None,
     ) -> None:
-        super().__init__(username, psk, platform, version)
+        super().__init__(username, psk, platform, version, verify)
 
         self.log_level = log_level
         self.dns_host = dns_host
@@ -234,6 +603,8 @@ class Reader(Checker):
         self.route_detour = route_detour
         self.multiplex = multiplex
         self.custom_rule_sets = custom_rule_sets
+        # Budget left for optional enrichments, None waits on every upstream.
+        self.deadline = deadline
 
     # ------------------------------------------------------------------
 
@@ -293,32 +664,27 @@ class Reader(Checker):
         route = self.template_data.get("route", {})
         rules = route.get("rules", [])
 
-        owner = "minlaxz"
-        repo = "nekohasekai"
-        branch = "route-rules"
-
-        api_url = f"https://api.github.com/repos/{owner}/{repo}/contents?ref={branch}"
-        response = httpx.get(api_url, timeout=HTTP_TIMEOUT)
-        response.raise_for_status()
-
-        files = response.json()
+        owner = ROUTE_RULES_OWNER
+        repo = ROUTE_RULES_REPO
+        branch = ROUTE_RULES_BRANCH
 
         rule_sets: List[Any] = []
         geosite_rule_sets: List[Any] = []
         geoip_rule_sets: List[Any] = []
 
-        for file in files:
-            if file["name"].endswith(".srs"):
-                tag = file["name"].replace(".srs", "")
-                rule_sets.append({
-                    "tag": tag,
-                    "type": "remote",
-                    "format": "binary",
-                    "url": f"https://cdn.jsdelivr.net/gh/{owner}/{repo}@{branch}/{file['name']}",
-                    "download_detour": self.route_detour,
-                    "update_interval": "1d",
-                })
-                geosite_rule_sets.append(tag)
+        # Shard names carry a hash of their content, a rule change gives only
+        # the shards it touched a new tag and URL for clients to download.
+        for name in list_route_rule_sets(self.deadline):
+            tag = name.replace(".srs", "")
+            rule_sets.append({
+                "tag": tag,
+                "type": "remote",
+                "format": "binary",
+                "url": f"{APP_JSDELIVR_URL}/gh/{owner}/{repo}@{branch}/{name}",
+                "download_detour": self.route_detour,
+                "update_interval": "1d",
+            })
+            geosite_rule_sets.append(tag)
 
         # App default rule sets from environment variable
         other_rule_sets = os.getenv("APP_DEFAULT_OTHER_RULE_SETS", "").split(",")
@@ -342,6 +708,7 @@ class Reader(Checker):
                 geosite_rule_sets,
                 self.route_detour,
                 skip_head=False,
+                deadline=self.deadline,
             )
 
         route["rule_set"] = rule_sets
@@ -395,18 +762,17 @@ class Reader(Checker):
                 ob["password"] = self.psk
 
             if ob.get("uuid") == "":
-                ob["uuid"] = next(
-                    (
-                        u["uuid"]
-                        for u in self.users_data.get("users", [])
-                        if u.get("name") == self.username
-                    ),
-                    "00000000-0000-0000-0000-000000000000",
+                ob["uuid"] = (
+                    self.user.uuid
+                    if self.user and self.user.uuid
+                    else "00000000-0000-0000-0000-000000000000"
                 )
 
             if not self.multiplex:
                 ob.pop("multiplex", None)
 
+            shard_outbound(ob, self.username)
+
             result.append(ob)
 
             tag = ob.get("tag")
@@ -419,7 +785,12 @@ class Reader(Checker):
 
         result.append({"type": "direct", "tag": "direct"})
 
-        now = datetime.now(ZoneInfo("Asia/Yangon")).strftime(
+        # Measured by the prober, dead outbounds are left out of the groups.
+        stable_tags = health.rank(stable_tags)
+        tcp_tags = health.rank(tcp_tags)
+        udp_tags = health.rank(udp_tags)
+
+        now = datetime.now(ZONE).strftime(
             "→ %Y-%m-%d %H:%M:%S NO-IP"
         )
 
@@ -470,7 +841,9 @@ class Reader(Checker):
         self._inject_endpoints()
         self._inject_routes()
 
-        return json.loads(json.dumps(self.template_data, ensure_ascii=False, indent=2))
+        # template_data is parsed fresh for every request, so it can be handed
+        # out as is instead of round-tripping it through another JSON copy.
+        return self.template_data
 
 
 def format_bytes(v: int) -> str:
@@ -491,43 +864,96 @@ def format_packets(v: int) -> str:
     return str(v)
 
 
-async def get_stats() -> List[Dict[str, Any]]:
-    async with httpx.AsyncClient(timeout=5) as client:
-        stats_upstream = f"{APP_SSM_UPSTREAM}/server/v1/stats"
-        users_upstream = f"{APP_SSM_UPSTREAM}/server/v1/users"
+class Stats(List[StatsRow]):
+    """
+    Rows of `get_stats`, `stale` when they come from ssm-cache.json.
+    """
 
-        try:
-            stats_r, users_r = await asyncio.gather(
-                client.get(stats_upstream),
-                client.get(users_upstream),
-            )
-            stats_r.raise_for_status()
-            users_r.raise_for_status()
+    def __init__(self, rows: List[StatsRow], stale: bool = False) -> None:
+        super().__init__(rows)
+        self.stale = stale
+        self.as_of = datetime.now(ZONE)
+
+
+async def get_stats() -> Stats:
+    """
+    Per user stats joined with uPSKs, sorted by download.
 
-            stats_data = stats_r.json()["users"]
-            users_data = users_r.json()["users"]
+    Concurrent callers share one pair of upstream requests and the same
+    list, treat it as read-only.
+    """
+    return await stats_flight.do(APP_SSM_UPSTREAM, _get_stats)
 
-            users_dict = {user["username"]: user for user in users_data}
 
-            for stat in stats_data:
-                username = stat["username"]
-                if username in users_dict:
-                    stat["uPSK"] = users_dict[username].get("uPSK")
+def _offline_stats() -> Optional[Stats]:
+    rows = offline.users()
+    if not rows:
+        return None
+    stats_data = Stats([StatsRow(row, row.get("uPSK")) for row in rows], stale=True)
+    stats_data.sort(key=lambda x: x.downlinkBytes, reverse=True)
+    stats_data.as_of = datetime.fromtimestamp(offline.mtime, ZONE)
+    return stats_data
 
-            # sort by raw bytes
-            stats_data.sort(key=lambda x: x.get("downlinkBytes", 0), reverse=True)  # type: ignore
 
-            for row in stats_data:
-                extra = {}
-                for k, v in row.items():
-                    if k.endswith("Bytes"):
-                        extra[k + "Human"] = format_bytes(v)
-                    elif k.endswith("Packets"):
-                        extra[k + "Human"] = format_packets(v)
+def _last_known_stats() -> Optional[Stats]:
+    """
+    The fresher of the last SSM API answer and ssm-cache.json, as stale rows.
+    """
+    cached = _offline_stats()
+    remembered = last_good_stats
+    if remembered is None:
+        return cached
+    if cached is not None and cached.as_of > remembered.as_of:
+        return cached
+    stats_data = Stats(list(remembered), stale=True)
+    stats_data.as_of = remembered.as_of
+    return stats_data
 
-                row.update(extra)
+
+async def _get_stats() -> Stats:
+    global last_good_stats
+
+    async with httpx.AsyncClient(timeout=5) as client:
+        # One SSM endpoint per shard, users only live on one of them.
+        upstreams = [f"{APP_SSM_UPSTREAM}{prefix}" for prefix in ssm_prefixes()]
+
+        async def fetch() -> Stats:
+            responses = await asyncio.gather(*(
+                client.get(f"{upstream}/server/v1/{kind}")
+                for upstream in upstreams
+                for kind in ("stats", "users")
+            ))
+            for r in responses:
+                r.raise_for_status()
+
+            psks = {
+                user["username"]: user.get("uPSK")
+                for r in responses[1::2]
+                for user in r.json()["users"]
+            }
+            stats_data = Stats([
+                StatsRow(stat, psks.get(stat["username"]))
+                for r in responses[::2]
+                for stat in r.json()["users"]
+            ])
+
+            # sort by raw bytes
+            stats_data.sort(key=lambda x: x.downlinkBytes, reverse=True)
 
             return stats_data
 
+        try:
+            stats_data = await ssm_breaker.call_async(fetch)
         except httpx.HTTPError as e:
-            raise HTTPException(status_code=502, detail=f"Upstream error: {str(e)}")
+            fallback = (
+                await asyncio.to_thread(_last_known_stats)
+                if ssm_unavailable(e)
+                else None
+            )
+            if fallback is None:
+                raise HTTPException(status_code=502, detail=f"Upstream error: {str(e)}")
+            logger.warning("SSM API unavailable (%s), serving last known stats", e)
+            return fallback
+
+        last_good_stats = stats_data
+        return stats_data
@@ -0,0 +1,105 @@
+import asyncio
+import shutil
+import socket
+import ssl
+import subprocess
+
+import pytest
+
+from app import prober
+from app.prober import (
+    APP_PROBE_BUCKET_MS,
+    HealthTable,
+    probe_outbound,
+    probe_outbounds,
+)
+
+
+async def _accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    writer.close()
+
+
+def _closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _probe_listener(context: "ssl.SSLContext | None", outbound: dict) -> "float | None":
+    async def main() -> "float | None":
+        server = await asyncio.start_server(_accept, "127.0.0.1", 0, ssl=context)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await probe_outbound({**outbound, "server_port": port}, timeout=2)
+
+    return asyncio.run(main())
+
+
+def test_probe_tcp_listener():
+    latency = _probe_listener(None, {"server": "127.0.0.1"})
+    assert latency is not None and latency >= 0
+
+
+def test_probe_tls_listener(tmp_path):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not installed")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+
+    outbound = {
+        "server": "127.0.0.1",
+        "tls": {"enabled": True, "server_name": "localhost"},
+    }
+    latency = _probe_listener(context, outbound)
+    assert latency is not None and latency >= 0
+
+
+def test_probe_closed_port():
+    outbound = {"server": "127.0.0.1", "server_port": _closed_port()}
+    assert asyncio.run(probe_outbound(outbound, timeout=2)) is None
+
+
+def test_probe_outbounds_drops_dead(monkeypatch):
+    monkeypatch.setattr(prober, "health", HealthTable())
+
+    async def main() -> None:
+        server = await asyncio.start_server(_accept, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            await probe_outbounds([
+                {"tag": "dead", "server": "127.0.0.1", "server_port": _closed_port()},
+                {"tag": "alive", "server": "127.0.0.1", "server_port": port},
+                {"tag": "detoured", "detour": "alive"},
+            ])
+
+    asyncio.run(main())
+    assert prober.health.rank(["dead", "alive", "detoured"]) == ["alive", "detoured"]
+
+
+def test_rank_ignores_jitter():
+    table = HealthTable()
+    edge = APP_PROBE_BUCKET_MS
+    for _ in range(5):
+        table.record("a", edge + 1)
+        table.record("b", edge + 2)
+    before = table.fingerprint()
+
+    # Jitter across the bucket edge neither reorders nor re-fingerprints.
+    for jitter in (-3, 3, -2, 4):
+        table.record("a", edge + jitter)
+        table.record("b", edge - jitter)
+        assert table.fingerprint() == before
+
+    # A real slowdown does.
+    for _ in range(10):
+        table.record("a", edge * 4)
+    assert table.rank(["a", "b"]) == ["b", "a"]
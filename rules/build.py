@@ -0,0 +1,194 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from typing import Any
+
+import typer
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+# Headless rule fields matched as one OR group, the only ones split over shards.
+DOMAIN_FIELDS = ("domain", "domain_suffix", "domain_keyword", "domain_regex")
+
+app = typer.Typer(help="Route rule set publisher")
+
+
+def bucket_of(entry: str, buckets: int) -> int:
+    """
+    Stable bucket of a domain entry. `.example.com` and `example.com` land
+    together, so a suffix and its domain change the same shard.
+    """
+    if buckets <= 1:
+        return 0
+    digest = hashlib.sha256(entry.strip(".").lower().encode()).digest()
+    return int.from_bytes(digest[:8], "big") % buckets
+
+
+def split(
+    rule_set: dict[str, Any], buckets: int
+) -> list[tuple[int, dict[str, Any]]]:
+    """
+    Split a source rule set into `buckets` rule sets matching the same domains,
+    returned with their bucket. Empty buckets are left out.
+
+    Domain fields are spread over the buckets, every other field of a rule
+    is kept whole in each piece so the union of the shards equals the rule.
+    Logical and inverted rules cannot be split and stay in bucket 0.
+    """
+    shards: list[list[dict[str, Any]]] = [[] for _ in range(buckets)]
+    for rule in rule_set.get("rules", []):
+        fields = [f for f in DOMAIN_FIELDS if f in rule]
+        if rule.get("type") == "logical" or rule.get("invert") or not fields:
+            shards[0].append(rule)
+            continue
+        others = {k: v for k, v in rule.items() if k not in DOMAIN_FIELDS}
+        pieces: list[dict[str, Any]] = [{} for _ in range(buckets)]
+        for field in fields:
+            values = rule[field] if isinstance(rule[field], list) else [rule[field]]
+            for value in sorted(set(values)):
+                pieces[bucket_of(value, buckets)].setdefault(field, []).append(value)
+        for shard, piece in zip(shards, pieces):
+            if piece:
+                shard.append({**piece, **others})
+    return [
+        (bucket, {"version": rule_set.get("version", 3), "rules": rules})
+        for bucket, rules in enumerate(shards)
+        if rules
+    ]
+
+
+def entries(rule_set: dict[str, Any]) -> int:
+    return sum(
+        len(v) if isinstance(v, list) else 1
+        for rule in rule_set["rules"]
+        for v in rule.values()
+    )
+
+
+def compile_rule_set(sing_box: str, rule_set: dict[str, Any], output: str) -> None:
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(rule_set, f, indent=2)
+    try:
+        subprocess.run(
+            [sing_box, "rule-set", "compile", f.name, "-o", output], check=True
+        )
+    finally:
+        os.unlink(f.name)
+
+
+def load_manifest(path: str) -> dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": MANIFEST_VERSION, "rule_sets": {}}
+
+
+def files_of(manifest: dict[str, Any]) -> set[str]:
+    return {
+        shard["file"]
+        for rule_set in manifest.get("rule_sets", {}).values()
+        for shard in rule_set.get("shards", [])
+    }
+
+
+@app.command()
+def build(
+    source: str = typer.Option("rules", help="Directory of *-rules.json files"),
+    out: str = typer.Option(
+        "rules/route-rules", help="Publish directory, holding the last publish"
+    ),
+    sing_box: str = typer.Option("sing-box", help="sing-box binary"),
+    buckets: int = typer.Option(8, help="Shards per large rule list"),
+    min_entries: int = typer.Option(
+        64, help="Rule lists with fewer entries are published as one shard"
+    ),
+    keep_days: float = typer.Option(
+        14, help="Days replaced shards stay, longer than any profile update interval"
+    ),
+    keep_manifests: int = typer.Option(
+        10, help="Replaced manifests whose shards stay regardless of age"
+    ),
+):
+    """
+    Compile every rule list into a full `.srs` and content-addressed shards.
+
+    Shards are named `<list>-<bucket>-<content hash>.srs`, a shard whose
+    content did not change keeps its name and is not compiled again. The
+    manifest lists the current shards and the shards of replaced manifests,
+    which are kept for `--keep-days` after they were replaced and for the
+    last `--keep-manifests` replacements, so clients that have not updated
+    their profile in a while can still download theirs.
+    """
+    os.makedirs(out, exist_ok=True)
+    manifest_path = os.path.join(out, MANIFEST)
+    previous = load_manifest(manifest_path)
+    manifest: dict[str, Any] = {"version": MANIFEST_VERSION, "rule_sets": {}}
+    compiled = reused = 0
+    now = time.time()
+
+    for path in sorted(glob.glob(os.path.join(source, "*-rules.json"))):
+        name = os.path.basename(path).removesuffix(".json")
+        with open(path) as f:
+            rule_set = json.load(f)
+
+        # The full list, for configs rendered before shards existed.
+        compile_rule_set(sing_box, rule_set, os.path.join(out, f"{name}.srs"))
+        with open(os.path.join(out, f"{name}.json"), "w") as f:
+            json.dump(rule_set, f, indent=2)
+
+        count = buckets if entries(rule_set) >= min_entries else 1
+        shards = []
+        for bucket, shard in split(rule_set, count):
+            body = json.dumps(shard, sort_keys=True, separators=(",", ":"))
+            digest = hashlib.sha256(body.encode()).hexdigest()[:12]
+            file = f"{name}-{bucket}-{digest}.srs"
+            if os.path.exists(os.path.join(out, file)):
+                reused += 1
+            else:
+                compile_rule_set(sing_box, shard, os.path.join(out, file))
+                compiled += 1
+            shards.append({"file": file, "entries": entries(shard)})
+        manifest["rule_sets"][name] = {"buckets": count, "shards": shards}
+
+    # Replaced manifests, newest first, as long as they are within the window.
+    current = files_of(manifest)
+    replaced = previous.get("replaced", [])
+    if files_of(previous) and files_of(previous) != current:
+        replaced.insert(0, {"at": now, "files": sorted(files_of(previous))})
+    manifest["replaced"] = [
+        r
+        for i, r in enumerate(replaced)
+        if i < keep_manifests or now - r["at"] < keep_days * 86400
+    ]
+
+    # Anything else in the last publish is a removed list or an expired shard.
+    keep = current | {f for r in manifest["replaced"] for f in r["files"]}
+    keep |= {MANIFEST}
+    keep |= {
+        f"{name}{ext}" for name in manifest["rule_sets"] for ext in (".srs", ".json")
+    }
+    for file in os.listdir(out):
+        if file not in keep and os.path.isfile(os.path.join(out, file)):
+            os.unlink(os.path.join(out, file))
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    typer.secho(
+        f"rules: {compiled} shards compiled, {reused} unchanged.",
+        fg=typer.colors.GREEN,
+        bold=True,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -1,7 +1,11 @@
+import copy
+import hashlib
 import json
 import logging
 import subprocess
 import time
+import urllib.parse
+import urllib.request
 from typing import Any
 
 import typer
@@ -12,6 +16,7 @@ logging.basicConfig(
 
 IPIFY_URL = "https://api.ipify.org"
 FILES = ["users.json", "configs/inbounds.json", "public/outbounds.json"]
+SERVICES = "configs/services.json"
 
 app = typer.Typer(help="Sing-box config generator")
 
@@ -29,6 +34,130 @@ def save(path: str, data: dict[str, Any]):
         json.dump(data, f, indent=2)
 
 
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _resolve(doc: Any, path: str) -> tuple[Any, str]:
+    """Parent container and last token of a JSON pointer."""
+    tokens = [_unescape(t) for t in path.split("/")[1:]]
+    parent = doc
+    for token in tokens[:-1]:
+        parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+    return parent, tokens[-1]
+
+
+def _get(doc: Any, path: str) -> Any:
+    if not path:
+        return doc
+    parent, token = _resolve(doc, path)
+    return parent[int(token)] if isinstance(parent, list) else parent[token]
+
+
+def _add(doc: Any, path: str, value: Any) -> Any:
+    if not path:
+        return value
+    parent, token = _resolve(doc, path)
+    if isinstance(parent, list):
+        parent.insert(len(parent) if token == "-" else int(token), value)
+    else:
+        parent[token] = value
+    return doc
+
+
+def _remove(doc: Any, path: str) -> Any:
+    parent, token = _resolve(doc, path)
+    value = _get(doc, path)
+    if isinstance(parent, list):
+        del parent[int(token)]
+    else:
+        del parent[token]
+    return value
+
+
+def apply_patch(doc: Any, patch: list[dict[str, Any]]) -> Any:
+    """Apply an RFC 6902 JSON Patch, as returned by `/c?cv=...`."""
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        path = op["path"]
+        match op["op"]:
+            case "add":
+                doc = _add(doc, path, op["value"])
+            case "remove":
+                _remove(doc, path)
+            case "replace":
+                if path:
+                    _remove(doc, path)
+                doc = _add(doc, path, op["value"])
+            case "move":
+                doc = _add(doc, path, _remove(doc, op["from"]))
+            case "copy":
+                doc = _add(doc, path, copy.deepcopy(_get(doc, op["from"])))
+            case "test":
+                if _get(doc, path) != op["value"]:
+                    raise ValueError(f"test failed at {path}")
+            case unknown:
+                raise ValueError(f"unknown op {unknown}")
+    return doc
+
+
+# Same placement as api/app/shards.py, keep them in sync.
+def shard_of(username: str, shards: int) -> int:
+    if shards <= 1:
+        return 0
+    return max(
+        range(shards),
+        key=lambda shard: hashlib.sha256(f"{shard}:{username}".encode()).digest()[:8],
+    )
+
+
+def shard_tag(base: str, shard: int) -> str:
+    return base if shard == 0 else f"{base}-{shard}"
+
+
+def ssm_endpoint(shard: int) -> str:
+    return "/" if shard == 0 else f"/shard-{shard}"
+
+
+def shard_inbounds(
+    inbounds: list[dict[str, Any]],
+    users: list[dict[str, Any]],
+    shards: int,
+    start_port: int,
+    tls_server_name: str,
+    tls_server_port: int,
+) -> list[dict[str, Any]]:
+    """One shadowsocks/shadowtls pair per shard, from the first pair as template."""
+    shadowsocks = next(i for i in inbounds if i.get("type") == "shadowsocks")
+    shadowtls = next(i for i in inbounds if i.get("type") == "shadowtls")
+    others = [i for i in inbounds if i.get("type") not in ("shadowsocks", "shadowtls")]
+
+    pairs: list[dict[str, Any]] = []
+    for shard in range(shards):
+        ss = copy.deepcopy(shadowsocks)
+        ss.update(
+            {
+                "tag": shard_tag("shadowsocks", shard),
+                "listen_port": start_port + 2 * shard,
+            }
+        )
+        tls = copy.deepcopy(shadowtls)
+        tls.update(
+            {
+                "tag": shard_tag("shadowtls", shard),
+                "listen_port": start_port + 2 * shard + 1,
+                "detour": ss["tag"],
+                "users": [u for u in users if shard_of(u["name"], shards) == shard],
+                "handshake": {
+                    "server": tls_server_name,
+                    "server_port": tls_server_port,
+                },
+            }
+        )
+        pairs += [ss, tls]
+    return others + pairs
+
+
 def get_server_ip():
     try:
         ip = subprocess.run(
@@ -109,37 +238,57 @@ def download(
 @app.command()
 def generate(
     ip: str = typer.Option(get_server_ip(), help="ShadowTLS server IP address"),
-    port: int = typer.Option(help="ShadowTLS listen port"),
+    port: int = typer.Option(0, help="ShadowTLS listen port, without --shards"),
     tls_server_name: str = typer.Option("mozilla.org", help="TLS server name"),
     tls_server_port: int = typer.Option(443, help="TLS server port"),
+    shards: int = typer.Option(
+        1, envvar="APP_SHARDS", help="Inbound pairs to spread users over"
+    ),
+    start_port: int = typer.Option(
+        8894, envvar="START_PORT", help="First port of the shards"
+    ),
+    end_port: int = typer.Option(8904, envvar="END_PORT", help="Last port of the shards"),
 ):
+    """Fill in inbounds.json and outbounds.json for this server.
+
+    With --shards N, users are spread over N shadowsocks/shadowtls pairs on
+    START_PORT..END_PORT. Use the same APP_SHARDS, START_PORT and END_PORT
+    as api.env, the API points every user at its own pair.
+    """
+    if shards > 1:
+        if 2 * shards > end_port - start_port + 1:
+            typer.secho(
+                f"cli: {shards} shards do not fit in ports {start_port}-{end_port}.",
+                fg=typer.colors.RED,
+            )
+            raise typer.Exit(code=1)
+        port = start_port + 1
+    elif not port:
+        typer.secho("cli: --port is required without --shards.", fg=typer.colors.RED)
+        raise typer.Exit(code=1)
+
     data: dict[str, Any] = {f: load(f) for f in FILES if load(f)}
 
     users = data.get("users.json", {}).get("users", [])
     inbounds = data.get("configs/inbounds.json", {}).get("inbounds", [])
     outbounds = data.get("public/outbounds.json", {}).get("outbounds", [])
 
-    for i in inbounds:
-        match i.get("type"):
-            case "shadowtls":
-                i.update(
-                    {
-                        "users": users,
-                        "listen_port": port,
-                        "handshake": {
-                            "server": tls_server_name,
-                            "server_port": tls_server_port,
-                        },
-                    }
-                )
-            case "shadowsocks":
-                i.update(
-                    {
-                        "listen_port": port - 1,
-                    }
-                )
-            case _:
-                pass
+    if inbounds:
+        # A single pair is shard 0 on port - 1 and port.
+        inbounds[:] = shard_inbounds(
+            inbounds, users, shards, port - 1, tls_server_name, tls_server_port
+        )
+
+    services = load(SERVICES)
+    if services:
+        # One SSM API endpoint per shard, the API knows where each user is.
+        for service in services.get("services", []):
+            if service.get("type") == "ssm-api":
+                service["servers"] = {
+                    ssm_endpoint(shard): shard_tag("shadowsocks", shard)
+                    for shard in range(shards)
+                }
+        save(SERVICES, services)
 
     for o in outbounds:
         match o.get("tag"):
@@ -190,5 +339,53 @@ def register():
     typer.secho("cli: register complete.", fg=typer.colors.GREEN, bold=True)
 
 
+@app.command()
+def patch(
+    base: str = typer.Argument(help="Config the patch was made against"),
+    patch_file: str = typer.Argument(help="JSON Patch from /c"),
+    output: str = typer.Option("", help="Where to write the result, defaults to base"),
+):
+    """Apply a JSON Patch from `/c?cv=...` to a saved config."""
+    patched = apply_patch(load(base), load(patch_file))
+    save(output or base, patched)
+    typer.secho(f"cli: patched {output or base}.", fg=typer.colors.GREEN)
+
+
+@app.command()
+def sync(
+    url: str = typer.Argument(help="Config URL, e.g. https://host/c?j=...&k=..."),
+    output: str = typer.Option("config.json", help="Local copy of the config"),
+):
+    """Fetch a config, downloading only a patch when a local copy exists."""
+    version_file = f"{output}.version"
+    try:
+        with open(version_file) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        version = ""
+
+    if version and load(output) is not None:
+        sep = "&" if urllib.parse.urlsplit(url).query else "?"
+        url = f"{url}{sep}cv={version}"
+
+    request = urllib.request.Request(url, headers={"User-Agent": "SFA/1.12.0 (cli; 1.12.0)"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        body = response.read()
+        content_type = response.headers.get("Content-Type", "")
+        new_version = response.headers.get("X-Config-Version", "")
+
+    if content_type.startswith("application/json-patch+json"):
+        save(output, apply_patch(load(output), json.loads(body)))
+        how = f"patched, {len(body)} bytes"
+    else:
+        save(output, json.loads(body))
+        how = f"full, {len(body)} bytes"
+
+    if new_version:
+        with open(version_file, "w") as f:
+            f.write(new_version)
+    typer.secho(f"cli: synced {output} ({how}).", fg=typer.colors.GREEN, bold=True)
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,599 @@
+import asyncio
+import base64
+import json
+import logging
+import random
+import re
+import secrets
+import statistics
+import subprocess
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+import httpx
+import typer
+
+from cli import shard_of
+
+# `cli` configures logging on import, replace it.
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    force=True,
+)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Same values as docker-compose.yaml, the API has to stay below `mem_limit`.
+CONTAINER = "scaffolds-api-1"
+MEM_LIMIT_MIB = 128
+CONCURRENCY = 64
+
+# Real client User-Agents, the API reads the platform from SFA/SFI and the
+# sing-box version from the part after the first `;`.
+USER_AGENTS = [
+    # (weight, user agent)
+    (12, "SFA/1.11.4 (479; sing-box 1.11.4)"),
+    (30, "SFA/1.12.3 (521; sing-box 1.12.3)"),
+    (18, "SFA/1.12.9 (527; sing-box 1.12.9)"),
+    (8, "SFI/1.11.4 (1.11.4; sing-box 1.11.4)"),
+    (20, "SFI/1.12.3 (1.12.3; sing-box 1.12.3)"),
+    (12, "SFI/1.12.9 (1.12.9; sing-box 1.12.9)"),
+]
+# Above this share of 429s the test measures admission, not the API.
+MAX_SHED = 0.05
+# Above this share of other errors the test measures the error path.
+MAX_ERRORS = 0.01
+STAND_IN_PORT = 9000
+# Synthetic users, kept apart from public/users.json written by cli.py.
+LOADTEST_USERS = Path("loadtest-users.json")
+# What the API container has to be pointed at, see sample.api.env.
+STAND_IN_ENV = (
+    "APP_SSM_UPSTREAM=http://host.docker.internal:{port}",
+    "APP_GITHUB_API=http://host.docker.internal:{port}",
+    "APP_JSDELIVR_URL=http://host.docker.internal:{port}",
+)
+
+app = typer.Typer(help="Load tests for the sing-box API container")
+
+
+def container_rss_mib(container: str) -> float | None:
+    """Memory usage of a running container as reported by `docker stats`."""
+    try:
+        usage = subprocess.run(
+            [
+                "docker",
+                "stats",
+                "--no-stream",
+                "--format",
+                "{{.MemUsage}}",
+                container,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split("/")[0].strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    units = {"KiB": 1 / 1024, "MiB": 1, "GiB": 1024, "B": 1 / (1 << 20)}
+    for unit, factor in units.items():
+        if usage.endswith(unit):
+            return float(usage[: -len(unit)]) * factor
+    return None
+
+
+def client_address(index: int) -> str:
+    """A distinct client IP per simulated device, sent as X-Forwarded-For."""
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+
+def check_shed(shed: int, total: int):
+    """Fail when admission rejected too much load for the numbers to count."""
+    if total and shed / total > MAX_SHED:
+        typer.secho(
+            f"loadtest: {shed / total:.0%} of requests got 429, raise APP_USER_RATE, "
+            "APP_USER_BURST, APP_IP_RATE and APP_IP_BURST on the API for load tests.",
+            fg=typer.colors.RED,
+            bold=True,
+        )
+        raise typer.Exit(code=1)
+
+
+def check_errors(errors: int, total: int):
+    """Fail when too many requests failed for other reasons than admission."""
+    if total and errors / total > MAX_ERRORS:
+        typer.secho(
+            f"loadtest: {errors / total:.0%} of requests failed, check the "
+            "username, PSK and the API logs.",
+            fg=typer.colors.RED,
+            bold=True,
+        )
+        raise typer.Exit(code=1)
+
+
+def random_agent() -> str:
+    return random.choices(
+        [ua for _, ua in USER_AGENTS], weights=[w for w, _ in USER_AGENTS]
+    )[0]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def sample_rss(container: str, samples: list[float], stop: asyncio.Event):
+    while not stop.is_set():
+        rss = await asyncio.to_thread(container_rss_mib, container)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def hammer(
+    client: httpx.AsyncClient,
+    params: dict[str, Any],
+    headers: dict[str, str],
+    deadline: float,
+    latencies: list[float],
+    errors: list[int],
+):
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            r = await client.get("/c", params=params, headers=headers)
+            if r.status_code != 200:
+                errors.append(r.status_code)
+        except httpx.HTTPError:
+            errors.append(0)
+        latencies.append(time.monotonic() - started)
+
+
+@app.command()
+def memory(
+    base_url: str = typer.Option("http://127.0.0.1:8000", help="API base URL"),
+    username: str = typer.Option("user", help="`j` query parameter"),
+    psk: str = typer.Option(..., help="`k` query parameter"),
+    concurrency: int = typer.Option(CONCURRENCY, help="Concurrent clients"),
+    duration: int = typer.Option(60, help="Test duration in seconds"),
+    container: str = typer.Option(CONTAINER, help="API container name"),
+    limit: int = typer.Option(MEM_LIMIT_MIB, help="Memory limit in MiB"),
+):
+    """
+    Hammer /c and check the API container stays under its memory limit.
+
+    All clients use one username, run the API with APP_USER_RATE and
+    APP_USER_BURST raised or most requests are rejected with 429. Every
+    client sends a real SFA/SFI User-Agent so /c renders configs.
+    """
+
+    latencies: list[float] = []
+    errors: list[int] = []
+    rss: list[float] = []
+
+    async def run():
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(container, rss, stop))
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(
+            base_url=base_url, timeout=30, limits=limits
+        ) as client:
+            deadline = time.monotonic() + duration
+            params = {"j": username, "k": psk}
+            await asyncio.gather(
+                *(
+                    hammer(
+                        client,
+                        params,
+                        {
+                            "user-agent": random_agent(),
+                            "x-forwarded-for": client_address(i),
+                        },
+                        deadline,
+                        latencies,
+                        errors,
+                    )
+                    for i in range(concurrency)
+                )
+            )
+        stop.set()
+        await sampler
+
+    asyncio.run(run())
+
+    total = len(latencies)
+    typer.echo(f"requests:   {total} ({total / duration:.1f} req/s)")
+    typer.echo(f"errors:     {len(errors)}")
+    if latencies:
+        typer.echo(f"p50:        {statistics.median(latencies) * 1000:.1f} ms")
+        typer.echo(f"p99:        {percentile(latencies, 99) * 1000:.1f} ms")
+    check_shed(errors.count(429), total)
+    check_errors(len(errors) - errors.count(429), total)
+
+    if not rss:
+        typer.secho(
+            f"loadtest: could not read memory of {container}.",
+            fg=typer.colors.YELLOW,
+        )
+        return
+
+    peak = max(rss)
+    typer.echo(f"peak RSS:   {peak:.1f} MiB of {limit} MiB at {concurrency} clients")
+    if peak >= limit:
+        typer.secho("loadtest: memory limit exceeded.", fg=typer.colors.RED, bold=True)
+        raise typer.Exit(code=1)
+    typer.secho("loadtest: within memory limit.", fg=typer.colors.GREEN, bold=True)
+
+
+# -------------------------------------------------------------------
+# Stand-ins for SSM, GitHub and jsDelivr
+# -------------------------------------------------------------------
+
+
+def load_users(path: Path) -> dict[str, str]:
+    """Usernames and passwords of a users.json file, as written by cli.py."""
+    with path.open() as f:
+        return {u["name"]: u["password"] for u in json.load(f)["users"]}
+
+
+def generate_users(path: Path, count: int):
+    users = [
+        {
+            "name": f"load-{i:05d}",
+            "password": base64.b64encode(secrets.token_bytes(16)).decode(),
+        }
+        for i in range(count)
+    ]
+    path.write_text(json.dumps({"users": users}, indent=2))
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Answers the upstream calls of the API with canned data:
+
+    - SSM: `/server/v1/users`, `/server/v1/users/<name>` and `/server/v1/stats`,
+      also under `/shard-<n>` with only that shard's users
+    - GitHub: `/repos/<owner>/<repo>/contents`, the route-rules listing
+    - jsDelivr: `/gh/...`, any `.srs` exists
+    """
+
+    users: dict[str, str] = {}
+    shards = 1
+    rule_sets = [f"rule-{i:03d}.srs" for i in range(40)]
+    latency = 0.0
+    hits: Counter = Counter()
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    def _reply(self, status: int, body: Any = None, head: bool = False):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def _counters(self, username: str) -> dict[str, Any]:
+        rng = random.Random(username)
+        grown = int(time.monotonic() * 1000)
+        return {
+            "username": username,
+            "uplinkBytes": rng.randrange(1 << 30) + grown,
+            "downlinkBytes": rng.randrange(1 << 33) + grown * 8,
+            "uplinkPackets": rng.randrange(1 << 20),
+            "downlinkPackets": rng.randrange(1 << 22),
+            "tcpSessions": rng.randrange(5000),
+            "udpSessions": rng.randrange(500),
+        }
+
+    def _route(self, head: bool):
+        if self.latency:
+            time.sleep(self.latency)
+        path = self.path.split("?")[0]
+        shard = 0
+        prefixed = re.match(r"/shard-(\d+)(/server/v1/.*)", path)
+        if prefixed:
+            shard, path = int(prefixed[1]), prefixed[2]
+
+        if path.startswith("/server/v1/"):
+            self.hits["ssm"] += 1
+            users = {
+                name: psk
+                for name, psk in self.users.items()
+                if shard_of(name, self.shards) == shard
+            }
+            if path == "/server/v1/users":
+                listing = [
+                    {**self._counters(name), "uPSK": psk} for name, psk in users.items()
+                ]
+                return self._reply(200, {"users": listing}, head)
+            if path == "/server/v1/stats":
+                stats = [self._counters(name) for name in users]
+                return self._reply(200, {"users": stats}, head)
+            name = path.rsplit("/", 1)[-1]
+            if name in users:
+                user = {**self._counters(name), "uPSK": self.users[name]}
+                user["uplinkBytes"] = user["downlinkBytes"] = 0  # Never over quota
+                return self._reply(200, user, head)
+            return self._reply(404, {"error": "user not found"}, head)
+
+        if path.startswith("/repos/"):
+            self.hits["github"] += 1
+            listing = [{"name": name, "type": "file"} for name in self.rule_sets]
+            return self._reply(200, listing, head)
+
+        if path.startswith("/gh/"):
+            self.hits["jsdelivr"] += 1
+            return self._reply(200 if path.endswith(".srs") else 404, {}, head)
+
+        self._reply(404, {"error": "not found"}, head)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+
+def start_stand_ins(
+    host: str, port: int, users: dict[str, str], latency_ms: float, shards: int = 1
+) -> ThreadingHTTPServer:
+    StandIn.users = users
+    StandIn.shards = shards
+    StandIn.latency = latency_ms / 1000
+    server = ThreadingHTTPServer((host, port), StandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Stand-ins for %d users listening on %s:%d", len(users), host, port)
+    for line in STAND_IN_ENV:
+        logging.info("  %s", line.format(port=port))
+    return server
+
+
+# -------------------------------------------------------------------
+# Fleet
+# -------------------------------------------------------------------
+
+
+class Recorder:
+    """Latencies and status codes per endpoint."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.statuses: dict[str, Counter] = {}
+
+    def add(self, endpoint: str, status: int, latency: float):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        self.statuses.setdefault(endpoint, Counter())[status] += 1
+
+    def report(self, duration: float):
+        typer.echo(
+            f"{'endpoint':<24}{'requests':>10}{'req/s':>9}{'p50 ms':>9}"
+            f"{'p99 ms':>9}{'429':>7}{'errors':>8}"
+        )
+        rows = list(self.latencies.items())
+        everything = [x for _, values in rows for x in values]
+        totals: Counter = sum(self.statuses.values(), Counter())
+        for endpoint, latencies in rows + [("total", everything)]:
+            statuses = totals if endpoint == "total" else self.statuses[endpoint]
+            count = len(latencies)
+            shed = statuses[429]
+            errors = count - statuses[200] - shed
+            typer.echo(
+                f"{endpoint:<24}{count:>10}{count / duration:>9.1f}"
+                f"{statistics.median(latencies) * 1000:>9.1f}"
+                f"{percentile(latencies, 99) * 1000:>9.1f}"
+                f"{shed:>7}{errors / count:>8.1%}"
+            )
+        failed = {s: n for s, n in totals.items() if s not in (200, 429)}
+        if failed:
+            typer.echo(f"error statuses (0 = connection error): {dict(failed)}")
+
+
+class Fleet:
+    """
+    Clients refreshing their remote profile on their own schedule, plus
+    bursts where a share of them refresh at once, like after a config change.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        recorder: Recorder,
+        users: dict[str, str],
+        deadline: float,
+    ):
+        self.client = client
+        self.recorder = recorder
+        self.users = list(users.items())
+        self.deadline = deadline
+        self.burst = asyncio.Event()
+
+    async def get(
+        self, endpoint: str, path: str, **kwargs: Any
+    ) -> httpx.Response | None:
+        started = time.monotonic()
+        try:
+            r = await self.client.get(path, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.add(endpoint, 0, time.monotonic() - started)
+            return None
+        self.recorder.add(endpoint, r.status_code, time.monotonic() - started)
+        return r
+
+    async def sleep(self, seconds: float, spread: float, fraction: float):
+        """Sleep until the next refresh, or until a burst picks this client."""
+        wake = min(time.monotonic() + seconds, self.deadline)
+        while time.monotonic() < wake:
+            burst = self.burst
+            try:
+                await asyncio.wait_for(burst.wait(), timeout=wake - time.monotonic())
+            except asyncio.TimeoutError:
+                return
+            if random.random() < fraction:
+                await asyncio.sleep(random.uniform(0, spread))
+                return
+            # Not part of this burst, the next one is already armed.
+
+    async def device(
+        self, index: int, interval: float, i_share: float, spread: float, fraction: float
+    ):
+        username, psk = self.users[index % len(self.users)]
+        agent = random_agent()
+        # Every device has its own refresh interval, the phase is random too.
+        own = interval * random.uniform(0.5, 1.5)
+        headers = {"user-agent": agent, "x-forwarded-for": client_address(index)}
+        params = {"j": username, "k": psk}
+
+        await self.sleep(random.uniform(0, own), spread, fraction)
+        while time.monotonic() < self.deadline:
+            await self.get("/c", "/c", params=params, headers=headers)
+            if random.random() < i_share:
+                platform = "i" if agent.startswith("SFI") else "a"
+                await self.get(
+                    "/i", "/i", params={**params, "p": platform}, headers=headers
+                )
+            await self.sleep(own * random.uniform(0.9, 1.1), spread, fraction)
+
+    async def admin(self, interval: float):
+        """Somebody watching the SSM views."""
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.monotonic() < self.deadline:
+            await self.get("/ssm/server/v1/users", "/ssm/server/v1/users")
+            await self.get("/ssm/metrics", "/ssm/metrics")
+            await asyncio.sleep(min(interval, max(0, self.deadline - time.monotonic())))
+
+    async def bursts(self, every: float):
+        while time.monotonic() + every < self.deadline:
+            await asyncio.sleep(every)
+            logging.info("Burst: config changed, clients refresh")
+            burst, self.burst = self.burst, asyncio.Event()
+            burst.set()
+
+
+@app.command("stand-ins")
+def stand_ins(
+    users_file: Path = typer.Option(LOADTEST_USERS, help="users.json"),
+    host: str = typer.Option("0.0.0.0", help="Listen address"),
+    port: int = typer.Option(STAND_IN_PORT, help="Listen port"),
+    latency_ms: float = typer.Option(20, help="Added upstream latency"),
+    shards: int = typer.Option(1, envvar="APP_SHARDS", help="Same as the API's"),
+):
+    """Only run the SSM, GitHub and jsDelivr stand-ins."""
+    server = start_stand_ins(host, port, load_users(users_file), latency_ms, shards)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+@app.command()
+def fleet(
+    base_url: str = typer.Option("http://127.0.0.1:8000", help="API base URL"),
+    users_file: Path = typer.Option(
+        LOADTEST_USERS, help="users.json served by the stand-ins"
+    ),
+    generate: int = typer.Option(
+        0, help="Write this many synthetic users to --users-file first"
+    ),
+    force: bool = typer.Option(False, help="Let --generate overwrite --users-file"),
+    clients: int = typer.Option(2000, help="Simulated devices"),
+    duration: int = typer.Option(300, help="Test duration in seconds"),
+    interval: float = typer.Option(60, help="Mean refresh interval in seconds"),
+    burst_every: float = typer.Option(120, help="Seconds between bursts, 0 disables"),
+    burst_fraction: float = typer.Option(0.5, help="Share of devices in a burst"),
+    burst_spread: float = typer.Option(5, help="Seconds a burst is spread over"),
+    i_share: float = typer.Option(0.02, help="Share of refreshes that also open /i"),
+    admins: int = typer.Option(2, help="Clients polling the SSM views"),
+    admin_interval: float = typer.Option(10, help="Seconds between SSM view polls"),
+    connections: int = typer.Option(512, help="Max open connections"),
+    stand_in: bool = typer.Option(True, help="Start the upstream stand-ins"),
+    stand_in_port: int = typer.Option(STAND_IN_PORT, help="Stand-in port"),
+    latency_ms: float = typer.Option(20, help="Added upstream latency"),
+    shards: int = typer.Option(1, envvar="APP_SHARDS", help="Same as the API's"),
+    container: str = typer.Option(CONTAINER, help="API container name"),
+    limit: int = typer.Option(MEM_LIMIT_MIB, help="Memory limit in MiB"),
+):
+    """Replay a fleet of SFA/SFI clients polling /c, /i and the SSM views."""
+
+    if generate:
+        if users_file.exists() and not force:
+            typer.secho(
+                f"loadtest: {users_file} exists, pass --force to overwrite it.",
+                fg=typer.colors.RED,
+            )
+            raise typer.Exit(code=1)
+        generate_users(users_file, generate)
+        logging.info("Wrote %d users to %s", generate, users_file)
+    users = load_users(users_file)
+    if not users:
+        typer.secho(f"loadtest: no users in {users_file}.", fg=typer.colors.RED)
+        raise typer.Exit(code=1)
+
+    server = None
+    if stand_in:
+        server = start_stand_ins("0.0.0.0", stand_in_port, users, latency_ms, shards)
+
+    recorder = Recorder()
+    rss: list[float] = []
+
+    async def run():
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(container, rss, stop))
+        limits = httpx.Limits(max_connections=connections)
+        async with httpx.AsyncClient(
+            base_url=base_url, timeout=30, limits=limits
+        ) as client:
+            fleet = Fleet(client, recorder, users, time.monotonic() + duration)
+            tasks = [
+                fleet.device(i, interval, i_share, burst_spread, burst_fraction)
+                for i in range(clients)
+            ]
+            tasks += [fleet.admin(admin_interval) for _ in range(admins)]
+            if burst_every:
+                tasks.append(fleet.bursts(burst_every))
+            await asyncio.gather(*tasks)
+        stop.set()
+        await sampler
+
+    asyncio.run(run())
+    if server is not None:
+        server.shutdown()
+        typer.echo(f"upstream calls: {dict(StandIn.hits)}")
+
+    if not recorder.latencies:
+        typer.secho("loadtest: no requests were sent.", fg=typer.colors.YELLOW)
+        return
+    recorder.report(duration)
+    totals: Counter = sum(recorder.statuses.values(), Counter())
+    check_shed(totals[429], sum(totals.values()))
+
+    if not rss:
+        typer.secho(
+            f"loadtest: could not read memory of {container}.",
+            fg=typer.colors.YELLOW,
+        )
+        return
+    typer.echo(
+        f"RSS:        peak {max(rss):.1f} MiB, mean {statistics.mean(rss):.1f} MiB "
+        f"of {limit} MiB at {clients} clients"
+    )
+    if max(rss) >= limit:
+        typer.secho("loadtest: memory limit exceeded.", fg=typer.colors.RED, bold=True)
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -5,7 +5,7 @@ curl -LsSf https://astral.sh/uv/install.sh | sh
 source ~/.bashrc
 uv venv --python python3.12 .venv
 source .venv/bin/activate
-uv pip install typer
+uv pip install typer httpx
 ###
 
 # Setup configuration files
@@ -16,6 +16,8 @@ mv sample.users.json users.json
 # Download the latest release of sing-box and generate the configuration file
 python cli.py download --force
 python cli.py generate --port 9999
+# Or spread users over inbound pairs, use the same values as api.env
+# python cli.py generate --shards 3 --start-port 8894 --end-port 8904
 ###
 
 # Move the sing-box binary, libcronet.so, and systemd service file to the appropriate locations